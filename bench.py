@@ -0,0 +1,379 @@
+"""
+Load test for the exchange: stands main.py up against a stub pixels API, seeds it, drives a mixed workload
+at a fixed concurrency and prints per-route latency and throughput as JSON.
+
+    python bench.py --users 50 --tasks 1000,10000,100000 --concurrency 32 --duration 20 --output bench.json
+
+Every database size gets a fresh server and data.db in a temporary directory, so runs can be compared
+against each other and against earlier output. Afterwards the server is restarted on the grown data.db to
+time a cold start, which --startup-target turns into a pass or fail.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import aiohttp
+import numpy as np
+from aiohttp import web
+
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+CANVAS_WIDTH = 242
+CANVAS_HEIGHT = 153
+MAGIC = "bench-magic"
+BULK_CHUNK = 50_000  # BULK_TASK_LIMIT
+DEFAULT_MIX = "fetch=60,create=10,reserve_submit=15,stats=10,balance=5"
+DEFAULT_RATELIMITS = ["get_pixels=10/1", "get_pixel=100/1", "get_size=10/1"]
+
+
+class StubPixels:
+    """
+    Enough of pixels.pythondiscord.com for the exchange: /get_pixels, /get_pixel and /get_size over an in-memory canvas,
+    each with a fixed window ratelimit reported through the same headers pixels sends
+    """
+
+    def __init__(self, ratelimits: dict):
+        self.canvas = np.zeros((CANVAS_HEIGHT, CANVAS_WIDTH, 3), dtype=np.uint8)
+        self.ratelimits = ratelimits  # endpoint -> (requests, seconds)
+        self.windows = {}  # endpoint -> (window start, requests used)
+        self.calls = defaultdict(int)
+        self.limited = defaultdict(int)
+        self.runner = None
+
+    def ratelimit(self, endpoint: str) -> dict:
+        """Headers for this request, with cooldown-reset set if it's over the limit"""
+        self.calls[endpoint] += 1
+        limit, period = self.ratelimits[endpoint]
+        now = time.monotonic()
+        started, used = self.windows.get(endpoint, (now, 0))
+        if now - started >= period:
+            started, used = now, 0
+        reset = period - (now - started)
+        if used >= limit:
+            self.limited[endpoint] += 1
+            return {"cooldown-reset": f"{reset:.3f}"}
+        self.windows[endpoint] = (started, used + 1)
+        return {"requests-limit": str(limit), "requests-remaining": str(limit - used - 1), "requests-reset": f"{reset:.3f}"}
+
+    async def get_pixels(self, request):
+        headers = self.ratelimit("get_pixels")
+        if "cooldown-reset" in headers:
+            return web.Response(status=429, headers=headers)
+        return web.Response(body=self.canvas.tobytes(), headers=headers)
+
+    async def get_pixel(self, request):
+        headers = self.ratelimit("get_pixel")
+        if "cooldown-reset" in headers:
+            return web.json_response({"message": "ratelimited"}, status=429, headers=headers)
+        x, y = int(request.query["x"]), int(request.query["y"])
+        return web.json_response({"x": x, "y": y, "rgb": self.canvas[y, x].tobytes().hex()}, headers=headers)
+
+    async def get_size(self, request):
+        headers = self.ratelimit("get_size")
+        if "cooldown-reset" in headers:
+            return web.json_response({"message": "ratelimited"}, status=429, headers=headers)
+        return web.json_response({"width": CANVAS_WIDTH, "height": CANVAS_HEIGHT}, headers=headers)
+
+    async def start(self, port: int):
+        app = web.Application()
+        app.add_routes([
+            web.get("/get_pixels", self.get_pixels),
+            web.get("/get_pixel", self.get_pixel),
+            web.get("/get_size", self.get_size),
+        ])
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class Recorder:
+    """Latencies and statuses per route"""
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.statuses = defaultdict(lambda: defaultdict(int))
+
+    async def request(self, session, method: str, route: str, url: str, **kwargs):
+        """Make a request, timing it under `route`. Returns (status, body)"""
+        started = time.perf_counter()
+        try:
+            async with session.request(method, url, **kwargs) as response:
+                body = await response.read()
+                status = response.status
+        except aiohttp.ClientError as e:
+            body, status = str(e).encode(), type(e).__name__
+        self.latencies[route].append(time.perf_counter() - started)
+        self.statuses[route][status] += 1
+        return status, body
+
+    def report(self, duration: float) -> dict:
+        routes = {}
+        for route, latencies in sorted(self.latencies.items()):
+            latencies = np.array(latencies) * 1000
+            routes[route] = {
+                "requests": len(latencies),
+                "rps": round(len(latencies) / duration, 2),
+                "p50_ms": round(float(np.percentile(latencies, 50)), 3),
+                "p99_ms": round(float(np.percentile(latencies, 99)), 3),
+                "max_ms": round(float(latencies.max()), 3),
+                "statuses": {str(status): count for status, count in sorted(self.statuses[route].items(), key=str)},
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {"routes": routes, "requests": total, "rps": round(total / duration, 2)}
+
+
+class Workload:
+    """The things a bench client does, each one or more requests against the exchange"""
+
+    def __init__(self, base: str, stub: StubPixels, users: list, recorder: Recorder):
+        self.base = base
+        self.stub = stub
+        self.users = users  # authorization tokens
+        self.recorder = recorder
+
+    def request(self, session, method: str, route: str, path: str, user: str = None, **kwargs):
+        headers = {"Authorization": user} if user else {}
+        return self.recorder.request(session, method, route, self.base + path, headers=headers, **kwargs)
+
+    async def fetch(self, session):
+        minimum_pay = random.choice(["", "?minimum_pay=1", "?minimum_pay=3"])
+        await self.request(session, "GET", "GET /tasks", "/tasks" + minimum_pay)
+
+    async def create(self, session):
+        task = {
+            "x": random.randrange(CANVAS_WIDTH),
+            "y": random.randrange(CANVAS_HEIGHT),
+            "color": "%06x" % random.randrange(0x1000000),
+            "pay": round(random.uniform(0.1, 2), 2),
+        }
+        await self.request(session, "POST", "POST /tasks", "/tasks", random.choice(self.users), json=task)
+
+    async def reserve_submit(self, session):
+        """Pick a task off GET /tasks, reserve it, paint the stub canvas and submit it, like a worker would"""
+        user = random.choice(self.users)
+        status, body = await self.request(session, "GET", "GET /tasks", "/tasks")
+        if status != 200 or not json.loads(body):
+            return
+        task_id = random.choice(json.loads(body))["id"]
+        status, body = await self.request(session, "GET", "GET /tasks/{id}", f"/tasks/{task_id}", user)
+        if status != 200:
+            return  # someone else got there first
+        task = json.loads(body)
+        self.stub.canvas[task["y"], task["x"]] = tuple(bytes.fromhex(task["color"]))
+        await self.request(session, "POST", "POST /tasks/{id}", f"/tasks/{task_id}", user)
+
+    async def stats(self, session):
+        await self.request(session, "GET", "GET /tasks/stats", "/tasks/stats", random.choice(self.users))
+
+    async def balance(self, session):
+        await self.request(session, "GET", "GET /balance", "/balance", random.choice(self.users))
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(","):
+        name, weight = part.split("=")
+        if not hasattr(Workload, name.strip()):
+            raise SystemExit(f"Unknown workload '{name}'")
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def parse_ratelimits(ratelimits: list) -> dict:
+    parsed = {}
+    for ratelimit in ratelimits:
+        endpoint, limit = ratelimit.split("=")
+        requests, seconds = limit.split("/")
+        parsed[endpoint] = (int(requests), float(seconds))
+    return parsed
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def start_server(directory: str, stub_port: int) -> tuple:
+    """
+    Run main:app under uvicorn in its own process, configured by a .env in `directory`, and wait until it's ready.
+    Returns (process, base url, startup timings)
+    """
+    with open(os.path.join(directory, ".env"), "w") as env:
+        env.write(
+            f"API_KEY=bench\nINFO_WEBHOOK=\nMAGIC_AUTHORIZATION={MAGIC}\nRESERVATIONS_OPEN=true\n"
+            f"API_BASE=http://127.0.0.1:{stub_port}\n"
+            f"DATABASE_FILE={os.path.join(directory, 'data.db')}\n"
+            f"CANVAS_HISTORY_FILE={os.path.join(directory, 'canvas.bin')}\n"
+            f"WORKER_STATE_FILE={os.path.join(directory, 'pixex.state')}\n"
+        )
+    port = free_port()
+    started = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", REPO, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+    )
+    base = f"http://127.0.0.1:{port}"
+    startup = {}
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() - started < 60:
+            if process.poll() is not None:
+                raise SystemExit(f"Server exited with {process.returncode} during startup")
+            try:
+                if "healthz_seconds" not in startup:
+                    async with session.get(base + "/healthz") as response:
+                        if response.status == 200:
+                            startup["healthz_seconds"] = round(time.perf_counter() - started, 3)
+                async with session.get(base + "/readyz") as response:
+                    if response.status == 200:
+                        startup["readyz_seconds"] = round(time.perf_counter() - started, 3)
+                        startup["stages"] = (await response.json())["stages"]
+                        return process, base, startup
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.02)
+    process.terminate()
+    raise SystemExit("Server wasn't ready within a minute")
+
+
+async def seed(session, base: str, user_count: int, task_count: int) -> list:
+    """Make `user_count` funded users and spread `task_count` open tasks among them with POST /tasks/bulk"""
+    users = [f"bench-user-{i}" for i in range(user_count)]
+    per_user = -(-task_count // user_count)
+    for user in users:
+        async with session.get(base + "/balance", headers={"Authorization": user}) as response:
+            user_id = (await response.json())["id"]
+        async with session.post(base + f"/balance/{user_id}", headers={"Authorization": MAGIC}, data=str(per_user * 5 + 1000)) as response:
+            response.raise_for_status()
+
+    remaining = task_count
+    for user in users:
+        count = min(per_user, remaining)
+        remaining -= count
+        while count > 0:
+            chunk = min(count, BULK_CHUNK)
+            count -= chunk
+            body = "\n".join(json.dumps({
+                "x": random.randrange(CANVAS_WIDTH),
+                "y": random.randrange(CANVAS_HEIGHT),
+                "color": "%06x" % random.randrange(0x1000000),
+                "pay": round(random.uniform(0.1, 5), 2),
+            }) for _ in range(chunk))
+            async with session.post(base + "/tasks/bulk", headers={"Authorization": user}, data=body) as response:
+                if response.status != 200:
+                    raise SystemExit(f"Seeding failed: {response.status} {await response.text()}")
+    return users
+
+
+async def drive(workload: Workload, weights: dict, concurrency: int, duration: float):
+    names = list(weights)
+    chances = [weights[name] for name in names]
+    deadline = time.monotonic() + duration
+
+    async def client(session):
+        while time.monotonic() < deadline:
+            await getattr(workload, random.choices(names, chances)[0])(session)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*[client(session) for _ in range(concurrency)])
+
+
+async def run(args, task_count: int) -> dict:
+    stub = StubPixels(parse_ratelimits(DEFAULT_RATELIMITS + args.ratelimit))
+    stub_port = free_port()
+    await stub.start(stub_port)
+    with tempfile.TemporaryDirectory(prefix="pixex-bench-") as directory:
+        process, base, startup = await start_server(directory, stub_port)
+        try:
+            started = time.perf_counter()
+            async with aiohttp.ClientSession() as session:
+                users = await seed(session, base, args.users, task_count)
+            seconds_seeding = time.perf_counter() - started
+            print(f"{task_count} tasks: seeded in {seconds_seeding:.1f}s, running for {args.duration}s", file=sys.stderr)
+
+            recorder = Recorder()
+            started = time.perf_counter()
+            await drive(Workload(base, stub, users, recorder), parse_mix(args.mix), args.concurrency, args.duration)
+            elapsed = time.perf_counter() - started
+
+            process.terminate()
+            process.wait()
+            process, _, restart = await start_server(directory, stub_port)
+            print(f"{task_count} tasks: restarted, ready in {restart['readyz_seconds']}s", file=sys.stderr)
+        finally:
+            process.terminate()
+            process.wait()
+            await stub.stop()
+        database_bytes = sum(
+            os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if name.startswith("data.db")
+        )
+    return {
+        "tasks": task_count,
+        "seconds_seeding": round(seconds_seeding, 3),
+        "seconds": round(elapsed, 3),
+        "database_bytes": database_bytes,
+        "upstream_calls": dict(stub.calls),
+        "upstream_ratelimited": dict(stub.limited),
+        "startup": startup,
+        "restart": restart,  # on the data.db the run left behind
+        **recorder.report(elapsed),
+    }
+
+
+async def main(args):
+    random.seed(args.seed)
+    results = {
+        "config": {
+            "users": args.users,
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "mix": parse_mix(args.mix),
+            "ratelimits": {endpoint: list(limit) for endpoint, limit in parse_ratelimits(DEFAULT_RATELIMITS + args.ratelimit).items()},
+            "seed": args.seed,
+        },
+        "runs": [],
+    }
+    for task_count in args.tasks:
+        results["runs"].append(await run(args, task_count))
+    if args.startup_target is not None:
+        results["config"]["startup_target"] = args.startup_target
+        results["startup_target_missed"] = [
+            run["tasks"] for run in results["runs"] if run["restart"]["readyz_seconds"] > args.startup_target
+        ]
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(output + "\n")
+    print(output)
+    return 1 if results.get("startup_target_missed") else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pixels write exchange against a stub pixels API")
+    parser.add_argument("--users", type=int, default=20, help="users to seed")
+    parser.add_argument("--tasks", type=lambda value: [int(count) for count in value.split(",")], default=[1000, 10000],
+                        help="open tasks to seed, comma separated for one run per database size")
+    parser.add_argument("--concurrency", type=int, default=16, help="clients making requests at once")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run each workload for")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"workload weights (default {DEFAULT_MIX})")
+    parser.add_argument("--ratelimit", action="append", default=[], metavar="ENDPOINT=REQUESTS/SECONDS",
+                        help=f"stub ratelimit, repeatable (defaults {' '.join(DEFAULT_RATELIMITS)})")
+    parser.add_argument("--seed", type=int, default=0, help="random seed, for repeatable workloads")
+    parser.add_argument("--output", help="also write the JSON report here")
+    parser.add_argument("--startup-target", type=float, metavar="SECONDS",
+                        help="fail if a restart on the grown data.db takes longer than this to be ready")
+    sys.exit(asyncio.run(main(parser.parse_args())))
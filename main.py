@@ -1,33 +1,87 @@
+from __future__ import annotations
+
 import asyncio
+import bisect
+import contextlib
+import contextvars
+import fcntl
+import functools
+import hashlib
+import heapq
+import importlib
+import io
+import json
+import mmap
+import os
+import queue
 import random
-from datetime import datetime, timedelta
+import socket
+import sqlite3
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from typing import Optional
 
 
-import aiohttp
-import numpy as np
 from dotenv import dotenv_values
-from PIL import Image
 from pony import orm
 from starlette.applications import Starlette
-from starlette.responses import JSONResponse, Response
-from starlette.routing import Route
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Match, Route, WebSocketRoute
+
+
+STARTED_AT = time.monotonic()  # startup stages are timed from here, once the imports we can't put off are done
+
+
+class LazyModule:
+    """A module that isn't imported until something on it is first used, so startup doesn't wait on it"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        # only called for attributes we haven't copied over yet
+        value = getattr(importlib.import_module(self.name), attribute)
+        setattr(self, attribute, value)
+        return value
+
+
+aiohttp = LazyModule("aiohttp")
+np = LazyModule("numpy")
+Image = LazyModule("PIL.Image")
 
 
 # NOTES ON WORKING WITH PONY AND ASYNCIO:
 #  DO NOT AWAIT WITHIN orm.db_session() or YOU WILL CAUSE DEADLOCK OR CORRUPTION
 #  Keep transaction windows short and sweet, like normal except more so.
+#  All database work goes through DB.read() / DB.write(), which run a plain function in its own
+#  db_session on a database thread. Those functions can't await, and should hand back plain data, not entities.
 
 RETURNED_TASK_COUNT = 48  # Number of tasks to return on GET /tasks
 EXPIRATION_OFFSET = timedelta(minutes=1)
+ARCHIVE_INTERVAL = 60  # seconds between compaction runs
+ARCHIVE_BATCH_SIZE = 500  # tasks moved per transaction
 MINIMUM_WAGE = 0.1
 MAX_PASS_LENGTH = 128
 # these are dynamically updated on a timer
 CANVAS_WIDTH = 242
 CANVAS_HEIGHT = 153
 CANVAS_REFRESH_RATE = 10  # seconds
-API_BASE = "https://pixels.pythondiscord.com"
 CONFIG = dotenv_values(".env")
+DATABASE_FILE = CONFIG.get("DATABASE_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "data.db")
+# how long settled tasks stay in the live table before being archived
+ARCHIVE_AFTER = timedelta(hours=float(CONFIG.get("ARCHIVE_AFTER_HOURS") or 24))
+CANVAS_HISTORY_FILE = CONFIG.get("CANVAS_HISTORY_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "canvas.bin")
+CANVAS_HISTORY_FRAMES = int(CONFIG.get("CANVAS_HISTORY_FRAMES") or 360)  # an hour of refreshes
+WORKER_STATE_FILE = CONFIG.get("WORKER_STATE_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "pixex.state")
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"  # names this process in the leader Lease
+API_BASE = CONFIG.get("API_BASE") or "https://pixels.pythondiscord.com"
+RESERVATIONS_OPEN = (CONFIG.get("RESERVATIONS_OPEN") or "").lower() in ("1", "true", "yes")
 
 API_KEY = CONFIG["API_KEY"]
 INFO_WEBHOOK = CONFIG["INFO_WEBHOOK"]
@@ -38,6 +92,44 @@ HEADERS = {
 }
 
 
+class Startup:
+    """
+    The server comes up in stages, so it can bind and answer the cheap endpoints straight away while the rest
+    loads in the background. Each stage records how long after STARTED_AT it finished.
+
+    serving: the database is bound, so /healthz, /tasks/stats, /balance and /metrics work
+    book: the open tasks are loaded, so listing, creating and reserving tasks work
+    reservations: every live reservation is back in the book and due to expire
+    ready: upstream, the canvas and the background jobs are running, so everything works
+    """
+    STAGES = ('serving', 'book', 'reservations', 'ready')
+
+    def __init__(self):
+        self.finished = {}  # stage -> seconds after STARTED_AT
+
+    def done(self, stage: str) -> bool:
+        return stage in self.finished
+
+    def finish(self, stage: str):
+        self.finished[stage] = round(time.monotonic() - STARTED_AT, 3)
+        print(f"Startup: {stage} after {self.finished[stage]}s")
+
+
+STARTUP = Startup()
+STARTING_UP = "We're still starting up, please try again in a moment."
+
+
+def requires(stage: str):
+    """Answer 503 until a startup stage is done"""
+    def decorator(function):
+        async def wrapped(request):
+            if not STARTUP.done(stage):
+                return Response(STARTING_UP, status_code=503, headers={"Retry-After": "1"})
+            return await function(request)
+        return wrapped
+    return decorator
+
+
 async def homepage(request):
     return Response(
         "Hello world! And welcome to Bast's Pixel Write Exchange!\n"
@@ -46,15 +138,36 @@ async def homepage(request):
         f"\nAll requests to the pixex api should have the 'Authorization' header set to a unique identifiable token of up to {MAX_PASS_LENGTH} characters that will be used to keep track of your accounting!"
         " Surrounding spaces will be stripped.\n"
         f"\nGET /tasks to get the top {RETURNED_TASK_COUNT} highest paying tasks. You may provide ?minimum_pay=<float> to filter.\n"
+        "\tAdd ?x0=<left>&y0=<top>&x1=<right>&y1=<bottom> to only see tasks with x0 <= x < x1 and y0 <= y < y1,"
+        " and ?x=<x>&y=<y> to get the closest tasks first instead of the best paid.\n"
         '\tReturns: [{"id": task_id, "pay": task_pay},]\n'
+        "\nGET /tasks/stream (server-sent events, or connect a websocket to the same path) instead of polling GET /tasks."
+        " Takes the same ?minimum_pay=<float>.\n"
+        f'\tSends {{"type": "snapshot", "tasks": [{{"id": task_id, "pay": task_pay}},]}} with the top {RETURNED_TASK_COUNT} tasks,'
+        ' then {"type": "add" | "reserve" | "remove", "tasks": [...]} as tasks come and go.'
+        " If you fall too far behind we close the stream; reconnect for a fresh snapshot.\n"
         "\nGET /tasks/<taskid> to claim a task. This claim will last 1 minute.\n"
         '\tReturns: {"id": task_id, "pay": task_pay, "x": x_coord, "y": y_coord, "color": hex_color, "expires": expiration_time}\n'
+        f"\nPOST /tasks/reserve to claim up to {MAX_BATCH_RESERVATION} of the best paying tasks in one go, all expiring together."
+        " Optionally restrict them to a rectangle covering x0 <= x < x1 and y0 <= y < y1.\n"
+        '\tFormat: {"count": task_count, "minimum_pay": float, "region": {"x0": left, "y0": top, "x1": right, "y1": bottom}}\n'
+        '\tReturns: [{"id": task_id, "pay": task_pay, "x": x_coord, "y": y_coord, "color": hex_color, "expires": expiration_time},]'
+        " with fewer tasks than you asked for if that's all there is.\n"
         "\nPOST /tasks/<taskid> to submit a task. We will verify whether the pixel has changed, and reward you with your payment.\n"
         "\tWe check every 10 seconds (or roughly the maximum view ratelimit) for new pixels globally, and faster with /get_pixel on individual submissions if available. "
         "It may take up to that long for your submission to return, so plan accordingly.\n"
         "\nPOST /tasks to create a task.\n"
         '\tFormat: {"pay": task_pay, "x": x_coord, "y": y_coord, "color": hex_color}\n'
-        '\tReturns: {"id": new_task_id}\n'
+        '\tReturns: {"id": new_task_id, "conflicts": [ids_of_other_live_tasks_for_that_pixel]}\n'
+        "\tAsking for the same pixel and color as a live task is refused with a 409.\n"
+        "\nPOST /tasks/bulk to create many tasks at once. Send either newline delimited json objects in the task format above,"
+        " or a PNG with Content-Type: image/png and ?x=<left>&y=<top>&pay=<float per pixel> (fully transparent pixels are skipped)."
+        " Add ?skip_matching=true to leave out pixels that already have the right color."
+        " Tasks that repeat a live task's pixel and color are left out and counted as duplicates."
+        " Uploads are limited to 50000 tasks, or a 50000 pixel PNG.\n"
+        '\tReturns: {"first_id": first_new_task_id, "last_id": last_new_task_id, "count": tasks_created, "skipped": pixels_skipped, "duplicates": duplicates_left_out}\n'
+        "\nGET /canvas.png for our latest copy of the canvas, and GET /tasks/heatmap.png for how much pay is on offer where."
+        " Both send an ETag, so poll with If-None-Match to get a 304 until they change.\n"
         "\nGET /balance to view your balance\n"
         '\tReturns: {"id": your_id, "balance": your_balance}\n'
         "\nDELETE /tasks/<task_id> to delete a task you've submitted. This will return an error if it's already been reserved.\n"
@@ -85,17 +198,404 @@ async def homepage(request):
     # "POST /balance/<user_id>" to add money to a user with the magic api token, useful for fixing the economy. Requires the integer amount in the request body
 
 
-async def fetch_tasks(request):
-    minimum_pay = request.query_params.get('minimum_pay')
+def minimum_pay_param(connection) -> float:
+    minimum_pay = connection.query_params.get('minimum_pay')
     if minimum_pay:
-        minimum_pay = float(minimum_pay)
-    else:
-        minimum_pay = MINIMUM_WAGE
+        return float(minimum_pay)
+    return MINIMUM_WAGE
+
+
+def region_param(request) -> Optional[tuple]:
+    keys = {'x0', 'y0', 'x1', 'y1'} & set(request.query_params)
+    if not keys:
+        return None
+    return parse_region({key: request.query_params[key] for key in keys})
+
+
+def point_param(request) -> Optional[tuple]:
+    if 'x' not in request.query_params and 'y' not in request.query_params:
+        return None
+    try:
+        return int(request.query_params['x']), int(request.query_params['y'])
+    except (KeyError, ValueError):
+        raise Rejected("Invalid point: x and y must both be given as integers")
+
+
+@requires('book')
+async def fetch_tasks(request):
+    body = TASK_BOOK.response(minimum_pay_param(request), region_param(request), point_param(request))
+    return Response(body, media_type="application/json")
+
+
+BookTask = namedtuple('BookTask', 'id pay x y color')
+
+
+class SpatialIndex:
+    """
+    Open tasks bucketed into CELL_SIZE square cells of the canvas, for rectangle and nearest-first queries.
+    Tasks outside the canvas (after it shrinks) are kept in the nearest edge cell.
+    """
+    CELL_SIZE = 16
+
+    def __init__(self, width: int, height: int):
+        self.resize(width, height)
+
+    def resize(self, width: int, height: int, tasks=()):
+        self.width = width
+        self.height = height
+        self.columns = max(-(-width // self.CELL_SIZE), 1)
+        self.rows = max(-(-height // self.CELL_SIZE), 1)
+        self.cells = [[{} for _ in range(self.columns)] for _ in range(self.rows)]  # task id -> BookTask
+        for task in tasks:
+            self.add(task)
+
+    def cell_index(self, x: int, y: int) -> tuple:
+        column = min(max(x // self.CELL_SIZE, 0), self.columns - 1)
+        row = min(max(y // self.CELL_SIZE, 0), self.rows - 1)
+        return row, column
+
+    def cell(self, x: int, y: int) -> dict:
+        row, column = self.cell_index(x, y)
+        return self.cells[row][column]
+
+    def add(self, task: BookTask):
+        self.cell(task.x, task.y)[task.id] = task
+
+    def discard(self, task: BookTask):
+        self.cell(task.x, task.y).pop(task.id, None)
+
+    def within(self, x0: int, y0: int, x1: int, y1: int):
+        """Every task with x0 <= x < x1 and y0 <= y < y1"""
+        # clamped like cell(), since edge cells also hold anything that fell off the canvas
+        first = self.cell_index(x0, y0)
+        last = self.cell_index(x1 - 1, y1 - 1)
+        for row in range(first[0], last[0] + 1):
+            for column in range(first[1], last[1] + 1):
+                for task in self.cells[row][column].values():
+                    if x0 <= task.x < x1 and y0 <= task.y < y1:
+                        yield task
+
+    def cell_distance(self, row: int, column: int, x: int, y: int) -> int:
+        """Squared distance from (x, y) to the closest pixel that could be in a cell"""
+        left = 0 if column == 0 else column * self.CELL_SIZE
+        right = sys.maxsize if column == self.columns - 1 else (column + 1) * self.CELL_SIZE - 1
+        top = 0 if row == 0 else row * self.CELL_SIZE
+        bottom = sys.maxsize if row == self.rows - 1 else (row + 1) * self.CELL_SIZE - 1
+        dx = max(left - x, 0, x - right)
+        dy = max(top - y, 0, y - bottom)
+        return dx * dx + dy * dy
+
+    def nearest(self, x: int, y: int, count: int, accept) -> list:
+        """The `count` accepted tasks closest to (x, y), breaking ties by pay"""
+        cells = sorted(
+            (self.cell_distance(row, column, x, y), row, column)
+            for row in range(self.rows) for column in range(self.columns)
+        )
+        best = []  # max-heap on (distance, -pay, id) of the closest `count` so far
+        for distance, row, column in cells:
+            if len(best) >= count and distance > -best[0][0]:
+                break  # nothing in this or any later cell can beat what we have
+            for task in self.cells[row][column].values():
+                if not accept(task):
+                    continue
+                entry = (-((task.x - x) ** 2 + (task.y - y) ** 2), task.pay, -task.id, task)
+                if len(best) < count:
+                    heapq.heappush(best, entry)
+                elif entry[:3] > best[0][:3]:
+                    heapq.heapreplace(best, entry)
+        return [entry[3] for entry in sorted(best, key=lambda entry: entry[:3], reverse=True)]
+
+
+class TaskBook:
+    """In-memory order book of the open tasks, kept sorted by pay so GET /tasks never touches the database"""
+    MAX_CACHED_RESPONSES = 256
+
+    def __init__(self, feed: 'TaskFeed'):
+        self.feed = feed  # told about every task that goes on offer, gets reserved, or leaves the book
+        self.tasks = {}  # task id -> BookTask, for every open task
+        self.order = []  # (-pay, id) for every open task, ascending, so the best payers come first
+        self.grid = SpatialIndex(CANVAS_WIDTH, CANVAS_HEIGHT)  # every open task, by where it is
+        self.pixels = {}  # (x, y) -> {task id: BookTask}, for every open or reserved task
+        self.reserved = {}  # task id -> (BookTask, reserver's user id), for every reserved task
+        self.satisfied = set()  # open task ids whose pixel already had the right color at the last canvas refresh
+        self.version = 0  # bumped on every change, so caches can tell when they're stale
+        self.responses = {}  # (minimum_pay, region, point) -> encoded GET /tasks response for the current version
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def flag_satisfied(self, task_ids):
+        """Keep open tasks whose pixel is already done out of GET /tasks until the canvas says otherwise"""
+        satisfied = set(task_ids)
+        if satisfied != self.satisfied:
+            self.satisfied = satisfied
+            self.responses.clear()
+
+    def __contains__(self, task_id):
+        return task_id in self.tasks
+
+    def changed(self):
+        self.version += 1
+        self.responses.clear()
+
+    def add(self, task: BookTask):
+        """Add an open task, or put a reserved one back on offer"""
+        if self.tasks.get(task.id) == task:
+            return  # already on offer: sync_loop reports our own writes back to us too
+        self.take(task.id)
+        self.tasks[task.id] = task
+        bisect.insort(self.order, (-task.pay, task.id))
+        self.grid.add(task)
+        self.pixels.setdefault((task.x, task.y), {})[task.id] = task
+        self.changed()
+        self.feed.publish('add', [task])
+
+    def add_many(self, tasks):
+        tasks = list(tasks)
+        for task in tasks:
+            self.tasks[task.id] = task
+            self.order.append((-task.pay, task.id))
+            self.grid.add(task)
+            self.pixels.setdefault((task.x, task.y), {})[task.id] = task
+        self.order.sort()
+        self.changed()
+        self.feed.publish('add', tasks)
+
+    def reserve(self, task: BookTask, user_id: int):
+        if self.reserved.get(task.id) == (task, user_id):
+            return
+        self.take(task.id)
+        self.reserved[task.id] = (task, user_id)
+        self.pixels.setdefault((task.x, task.y), {})[task.id] = task
+        self.changed()
+        self.feed.publish('reserve', [task])
+
+    def restore_reserved(self, reserved: list):
+        """Put (BookTask, reserver's user id) pairs recovered at startup into the book"""
+        newly_reserved = [task for task, _ in reserved if task.id in self.tasks]
+        for task, user_id in reserved:
+            self.take(task.id)
+            self.reserved[task.id] = (task, user_id)
+            self.pixels.setdefault((task.x, task.y), {})[task.id] = task
+        self.changed()
+        if newly_reserved:  # subscribers only hear about the ones they saw on offer
+            self.feed.publish('reserve', newly_reserved)
+
+    def remove(self, task_id: int) -> Optional[BookTask]:
+        """Take a task out of the book, whether open or reserved"""
+        was_open = task_id in self.tasks
+        task = self.take(task_id)
+        if task is None:
+            return None
+        self.changed()
+        if was_open:  # subscribers only ever see open tasks, and were told when this one got reserved
+            self.feed.publish('remove', [task])
+        return task
+
+    def take(self, task_id: int) -> Optional[BookTask]:
+        """Drop a task from whichever side of the book holds it, without telling anyone"""
+        reserved = self.reserved.pop(task_id, None)
+        if reserved:
+            task = reserved[0]
+        else:
+            task = self.tasks.pop(task_id, None)
+            if task is None:
+                return None
+            index = bisect.bisect_left(self.order, (-task.pay, task.id))
+            del self.order[index]
+            self.grid.discard(task)
+            self.satisfied.discard(task_id)
+        on_pixel = self.pixels[task.x, task.y]
+        del on_pixel[task_id]
+        if not on_pixel:
+            del self.pixels[task.x, task.y]
+        return task
+
+    def on_pixel(self, x: int, y: int) -> list:
+        """Every open or reserved task for a pixel"""
+        return list(self.pixels.get((x, y), {}).values())
+
+    def resize(self, width: int, height: int):
+        self.grid.resize(width, height, self.tasks.values())
+
+    def rebuild(self, tasks, reserved=()):
+        self.tasks = {task.id: task for task in tasks}
+        self.order = sorted((-task.pay, task.id) for task in self.tasks.values())
+        self.reserved = {task.id: (task, user_id) for task, user_id in reserved}
+        self.grid.resize(CANVAS_WIDTH, CANVAS_HEIGHT, self.tasks.values())
+        self.pixels = {}
+        for task in list(self.tasks.values()) + [task for task, _ in self.reserved.values()]:
+            self.pixels.setdefault((task.x, task.y), {})[task.id] = task
+        self.satisfied = set()
+        self.changed()
+
+    def top(self, minimum_pay: float, count: int = RETURNED_TASK_COUNT, region: Optional[tuple] = None):
+        """
+        The `count` highest paying open tasks paying at least `minimum_pay`, optionally only inside `region`,
+        leaving out the ones the canvas already shows as done
+        """
+        if region:
+            found = [
+                task for task in self.grid.within(*region)
+                if task.pay >= minimum_pay and task.id not in self.satisfied
+            ]
+            return heapq.nsmallest(count, found, key=lambda task: (-task.pay, task.id))
+        result = []
+        for negative_pay, task_id in self.order:
+            if -negative_pay < minimum_pay or len(result) >= count:
+                break
+            if task_id not in self.satisfied:
+                result.append(self.tasks[task_id])
+        return result
+
+    def nearest(self, x: int, y: int, minimum_pay: float, count: int = RETURNED_TASK_COUNT, region: Optional[tuple] = None):
+        """The `count` open tasks closest to (x, y) paying at least `minimum_pay`, optionally only inside `region`"""
+        def accept(task):
+            if task.pay < minimum_pay or task.id in self.satisfied:
+                return False
+            return not region or (region[0] <= task.x < region[2] and region[1] <= task.y < region[3])
+        return self.grid.nearest(x, y, count, accept)
+
+    def response(self, minimum_pay: float, region: Optional[tuple] = None, point: Optional[tuple] = None) -> bytes:
+        """The encoded GET /tasks body, cached until the book or its done-on-the-canvas flags next change"""
+        key = (minimum_pay, region, point)
+        body = self.responses.get(key)
+        if body is None:
+            if len(self.responses) >= self.MAX_CACHED_RESPONSES:
+                self.responses.clear()
+            if point:
+                tasks = self.nearest(*point, minimum_pay, region=region)
+            else:
+                tasks = self.top(minimum_pay, region=region)
+            body = json.dumps(
+                [{"id": task.id, "pay": task.pay} for task in tasks],
+                separators=(",", ":"),
+            ).encode("utf-8")
+            self.responses[key] = body
+        return body
 
-    with orm.db_session():
-        top_ten_payers = orm.select(task for task in Task if not task.completed and not task.deleted and not task.reservation and task.pay >= minimum_pay).order_by(orm.desc(Task.pay))[:RETURNED_TASK_COUNT]
-        top_ten_payers = [{"id": task.id, "pay": task.pay} for task in top_ten_payers]
-    return JSONResponse(top_ten_payers)
+
+STREAM_QUEUE_SIZE = 256  # messages a stream subscriber may fall behind before we drop it
+STREAM_KEEPALIVE = 15  # seconds between SSE keepalive comments, well under proxy read timeouts
+FeedMessage = namedtuple('FeedMessage', 'text sse')  # the same event, as a websocket text frame and as an SSE frame
+
+
+def feed_message(kind: str, tasks_json: str) -> FeedMessage:
+    text = '{"type":"%s","tasks":%s}' % (kind, tasks_json)
+    return FeedMessage(text, f"event: {kind}\ndata: {text}\n\n".encode("utf-8"))
+
+
+class Subscription:
+    def __init__(self, minimum_pay: float):
+        self.minimum_pay = minimum_pay
+        self.queue = asyncio.Queue(STREAM_QUEUE_SIZE)  # FeedMessages, then None once we've given up on this subscriber
+
+
+class TaskFeed:
+    """
+    Fans task book changes out to /tasks/stream subscribers.
+    Each change is encoded once per distinct minimum_pay among the subscribers rather than once per subscriber,
+    and a subscriber whose queue fills up is dropped instead of buffered forever. It can reconnect for a fresh snapshot.
+    """
+    def __init__(self):
+        self.subscribers = set()
+
+    def __len__(self):
+        return len(self.subscribers)
+
+    def subscribe(self, minimum_pay: float) -> Subscription:
+        subscription = Subscription(minimum_pay)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscribers.discard(subscription)
+
+    def drop(self, subscription: Subscription):
+        self.unsubscribe(subscription)
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+
+    def publish(self, kind: str, tasks: list):
+        if not self.subscribers:
+            return
+        messages = {}  # minimum_pay -> FeedMessage, or None if no task clears it
+        for subscription in list(self.subscribers):
+            minimum_pay = subscription.minimum_pay
+            if minimum_pay not in messages:
+                visible = [{"id": task.id, "pay": task.pay} for task in tasks if task.pay >= minimum_pay]
+                messages[minimum_pay] = visible and feed_message(kind, json.dumps(visible, separators=(",", ":")))
+            message = messages[minimum_pay]
+            if not message:
+                continue
+            try:
+                subscription.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.drop(subscription)
+
+
+TASK_FEED = TaskFeed()
+TASK_BOOK = TaskBook(TASK_FEED)
+
+
+def stream_snapshot(minimum_pay: float) -> tuple:
+    """Subscribe to the feed and take the matching snapshot in one step, so no change can fall between them"""
+    snapshot = feed_message('snapshot', TASK_BOOK.response(minimum_pay).decode("utf-8"))
+    return TASK_FEED.subscribe(minimum_pay), snapshot
+
+
+@requires('book')
+async def stream_tasks(request):
+    minimum_pay = minimum_pay_param(request)
+
+    async def events():
+        subscription, snapshot = stream_snapshot(minimum_pay)
+        try:
+            yield snapshot.sse
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), STREAM_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+                if message is None:
+                    return
+                yield message.sse
+        finally:
+            TASK_FEED.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def stream_tasks_websocket(websocket):
+    minimum_pay = minimum_pay_param(websocket)
+    if not STARTUP.done('book'):
+        await websocket.close(code=1013)  # try again later
+        return
+    await websocket.accept()
+    subscription, snapshot = stream_snapshot(minimum_pay)
+    closed = asyncio.ensure_future(websocket.receive())  # we never expect anything from the client but its goodbye
+    try:
+        await websocket.send_text(snapshot.text)
+        while True:
+            next_message = asyncio.ensure_future(subscription.queue.get())
+            await asyncio.wait((next_message, closed), return_when=asyncio.FIRST_COMPLETED)
+            if closed.done():
+                next_message.cancel()
+                return
+            message = next_message.result()
+            if message is None:
+                await websocket.close(code=1013)  # try again later
+                return
+            await websocket.send_text(message.text)
+    finally:
+        closed.cancel()
+        TASK_FEED.unsubscribe(subscription)
 
 
 async def task_stats(request):
@@ -103,31 +603,22 @@ async def task_stats(request):
     if authorization and len(authorization.strip()) > MAX_PASS_LENGTH:
         return Response(f"Auth tokens must be {MAX_PASS_LENGTH} characters or less in size", status_code=401)
 
-    with orm.db_session():
-        response = {
-            "available": orm.count(task for task in Task if not task.completed and not task.deleted and not task.reservation),
-            "all_completed": orm.count(task for task in Task if task.completed and not task.deleted),
-            "all_reserved": orm.count(task for task in Task if task.reservation and not task.completed and not task.deleted),
-        }
+    user_id = authorization and AUTH_CACHE.get(authorization.strip())
 
+    def read_stats():
+        response = Stats.get(user=None).to_global_dict()
         if authorization:
-            user = User.get(identifier=authorization.strip())
-            response.update({
-                "average_pay": orm.avg(task.pay for task in Task if task.completed and task.reservation == user),
-                "total_earnings": orm.sum(task.pay for task in Task if task.completed and task.reservation == user),
-                "completed": orm.count(task for task in Task if task.completed == user and not task.deleted),
-                "reserved": orm.count(task for task in Task if task.reservation == user and not task.completed and not task.deleted),
-                "submitted": orm.count(task for task in Task if task.creator == user),
-                "services_provided": orm.count(task for task in Task if task.creator == user and task.completed and not task.deleted),
-                "paid": orm.sum(task.pay for task in Task if task.creator == user and not task.completed),
-                "waiting_payments": orm.sum(task.pay for task in Task if task.creator == user and not task.reservation and not task.deleted and not task.completed),
-                "waiting": orm.count(task for task in Task if task.creator == user and not task.reservation and not task.deleted and not task.completed),
-                "deleted": orm.count(task for task in Task if task.creator == user and task.deleted),
-            })
-            if response["completed"] >= 1000:
-                response["message"] = "Glad to have you here! The 1k club is proud of it's members!"
-            if response["submitted"] > 10:
-                response["submitters_club"] = "Welcome! Enjoy your stay!"
+            user = User.get(id=user_id) if user_id else User.get(identifier=authorization.strip())
+            stats = user and Stats.get(user=user)
+            response.update(stats.to_user_dict() if stats else Stats.empty_user_dict())
+        return response
+
+    response = await DB.read(read_stats)
+    if authorization:
+        if response["completed"] >= 1000:
+            response["message"] = "Glad to have you here! The 1k club is proud of it's members!"
+        if response["submitted"] > 10:
+            response["submitters_club"] = "Welcome! Enjoy your stay!"
 
     return JSONResponse(response)
 
@@ -145,6 +636,7 @@ def enforce_auth(function):
 
 
 @enforce_auth
+@requires('book')
 async def create_task(request):
     authorization = request.headers.get('Authorization', None)
 
@@ -204,10 +696,21 @@ async def create_task(request):
     if pay < MINIMUM_WAGE:
         return Response(f"Invalid pay '{pay}': you can't offer pay below the minimum wage of {MINIMUM_WAGE} cats per pixel.", status_code=400)
 
-    with orm.db_session():
-        user = User.get_from_authorization(authorization)
+    on_pixel = TASK_BOOK.on_pixel(x, y)
+
+    user_id = await authenticate(authorization)
+
+    def create():
+        user = User[user_id]
         if user.money < pay:
-            return Response("Invalid payment offer: pay must be less than what you current have banked.", status_code=400)
+            raise Rejected("Invalid payment offer: pay must be less than what you current have banked.")
+
+        # checked here rather than against TASK_BOOK, so two offers for the same pixel can't both get in
+        duplicate = Task.select(
+            lambda t: t.x == x and t.y == y and t.color == color and t.status in (OPEN, RESERVED)
+        ).first()
+        if duplicate:
+            raise Rejected(f"Duplicate task: task id '{duplicate.id}' already asks for ({x}, {y}) to be {color}", status_code=409)
 
         new_task = Task(
             creator=user,
@@ -216,61 +719,357 @@ async def create_task(request):
             color=color,
             pay=pay,
         )
+        record_stats(new_task)
 
         user.money -= pay
+        orm.flush()
+        return new_task.id
+
+    task_id = await DB.write(create)
+    AUTH_CACHE.forget_balance(user_id)
 
-    response_json = {"id": new_task.id}
+    TASK_BOOK.add(BookTask(task_id, pay, x, y, color))
+
+    response_json = {"id": task_id, "conflicts": [other.id for other in on_pixel]}
     if random.random() < 0.5:
         response_json["message"] = "Thanks for making the world a better place!"
 
-    await log("New task created!", id=new_task.id, x=x, y=y, pay=pay, color=color, user=user.id)
+    await log("New task created!", id=task_id, x=x, y=y, pay=pay, color=color, user=user_id)
 
     return JSONResponse(response_json)
 
 
+BULK_TASK_LIMIT = 50_000
+BULK_BODY_LIMIT = BULK_TASK_LIMIT * 128  # bytes, a generous NDJSON line for every task allowed
+
+
+async def read_body(request, limit: int) -> Optional[bytes]:
+    """The request body, or None as soon as it turns out to be longer than `limit` bytes"""
+    content_length = request.headers.get('Content-Length', '')
+    if content_length.isdigit() and int(content_length) > limit:
+        return None
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+@enforce_auth
+@requires('book')
+async def create_tasks_bulk(request):
+    authorization = request.headers.get('Authorization', None)
+    body = await read_body(request, BULK_BODY_LIMIT)
+    if body is None:
+        return Response(f"Invalid bulk upload: the body must be at most {BULK_BODY_LIMIT} bytes", status_code=413)
+
+    try:
+        if request.headers.get('Content-Type', '').startswith('image/png'):
+            xs, ys, rgb, pays = parse_png_tasks(body, request.query_params)
+        else:
+            xs, ys, rgb, pays = parse_ndjson_tasks(body)
+    except ValueError as e:
+        return Response(f"Invalid bulk upload: {e}", status_code=400)
+
+    out_of_bounds = (xs < 0) | (xs >= CANVAS_WIDTH) | (ys < 0) | (ys >= CANVAS_HEIGHT)
+    if out_of_bounds.any():
+        first = np.argmax(out_of_bounds)
+        return Response(
+            f"Invalid bulk upload: {out_of_bounds.sum()} pixels fall outside the {CANVAS_WIDTH}x{CANVAS_HEIGHT} canvas, "
+            f"starting with ({xs[first]}, {ys[first]})",
+            status_code=400,
+        )
+
+    underpaid = ~(pays >= MINIMUM_WAGE)
+    if underpaid.any():
+        return Response(f"Invalid bulk upload: {underpaid.sum()} tasks offer pay below the minimum wage of {MINIMUM_WAGE} cats per pixel", status_code=400)
+
+    skipped = 0
+    if request.query_params.get('skip_matching', '').lower() in ('1', 'true', 'yes') and CURRENT_CANVAS is not None:
+        keep = ~pixels_match(CURRENT_CANVAS, xs, ys, rgb)
+        skipped = int((~keep).sum())
+        xs, ys, rgb, pays = xs[keep], ys[keep], rgb[keep], pays[keep]
+
+    hexes = rgb.tobytes().hex()
+    colors = [hexes[i:i + 6] for i in range(0, len(hexes), 6)]
+    offered = list(zip(xs.tolist(), ys.tolist(), colors, pays.tolist()))
+
+    user_id = await authenticate(authorization)
+
+    def create():
+        user = User[user_id]
+        # checked here rather than against TASK_BOOK, so two uploads for the same pixels can't both get in
+        rows = drop_duplicate_tasks(offered, live_task_colors({(x, y) for x, y, _, _ in offered}))
+        total_pay = float(sum(row[3] for row in rows))
+        if user.money < total_pay:
+            raise Rejected(f"Invalid payment offer: these {len(rows)} tasks cost {total_pay} cats, more than you currently have banked.")
+        if not rows:
+            return None, rows, total_pay
+
+        user.money -= total_pay
+        record_open_tasks(user, len(rows), total_pay)
+        orm.flush()  # starts the write transaction, which the raw insert below then joins
+        # One executemany is far quicker than building thousands of entities
+        cursor = db.get_connection().cursor()
+        cursor.executemany(
+            'INSERT INTO "Task" ("creator", "deleted", "x", "y", "color", "pay", "status") VALUES (?, 0, ?, ?, ?, ?, ?)',
+            [(user.id, x, y, color, pay, OPEN) for x, y, color, pay in rows],
+        )
+        return cursor.execute('SELECT last_insert_rowid()').fetchone()[0], rows, total_pay
+
+    last_id, rows, total_pay = await DB.write(create)
+    duplicates = len(offered) - len(rows)
+    AUTH_CACHE.forget_balance(user_id)
+    if last_id is None:
+        return JSONResponse({"first_id": None, "last_id": None, "count": 0, "skipped": skipped, "duplicates": duplicates})
+
+    # a single transaction on the only writer, so the ids are contiguous
+    first_id = last_id - len(rows) + 1
+    TASK_BOOK.add_many(BookTask(task_id, pay, x, y, color) for task_id, (x, y, color, pay) in enumerate(rows, first_id))
+
+    await log("Tasks created in bulk!", first_id=first_id, last_id=last_id, count=len(rows), pay=total_pay, user=user_id)
+
+    return JSONResponse({"first_id": first_id, "last_id": last_id, "count": len(rows), "skipped": skipped, "duplicates": duplicates})
+
+
+LIVE_TASK_CHUNK = 400  # pixels looked up per query, keeping under SQLite's default limit of 999 bound variables
+
+
+def live_task_colors(pixels) -> set:
+    """(x, y, color) of every open or reserved task on the given (x, y) pixels, from inside a DB unit"""
+    pixels = list(pixels)
+    connection = db.get_connection()
+    found = set()
+    for start in range(0, len(pixels), LIVE_TASK_CHUNK):
+        chunk = pixels[start:start + LIVE_TASK_CHUNK]
+        # CROSS JOIN and the unary + keep SQLite looking each pixel up on idx_task__x_y,
+        # rather than walking every live task by status
+        found.update(connection.execute(
+            'WITH "wanted" ("x", "y") AS (VALUES %s) '
+            'SELECT "Task"."x", "Task"."y", "Task"."color" FROM "wanted" CROSS JOIN "Task" '
+            'ON "Task"."x" = "wanted"."x" AND "Task"."y" = "wanted"."y" WHERE +"Task"."status" IN (?, ?)'
+            % ", ".join(["(?, ?)"] * len(chunk)),
+            [value for pixel in chunk for value in pixel] + [OPEN, RESERVED],
+        ).fetchall())
+    return found
+
+
+def drop_duplicate_tasks(rows, live: set) -> list:
+    """Leave out (x, y, color, pay) rows that repeat a live (x, y, color), or an earlier row"""
+    seen = set(live)
+    kept = []
+    for row in rows:
+        x, y, color, _ = row
+        if (x, y, color) in seen:
+            continue
+        seen.add((x, y, color))
+        kept.append(row)
+    return kept
+
+
+def parse_ndjson_tasks(body: bytes) -> tuple:
+    """Read newline delimited task objects into (xs, ys, rgb, pays) arrays"""
+    xs, ys, colors, pays = [], [], [], []
+    for number, line in enumerate(body.splitlines(), 1):
+        if not line.strip():
+            continue
+        if len(xs) >= BULK_TASK_LIMIT:
+            raise ValueError(f"at most {BULK_TASK_LIMIT} tasks can be created at once")
+        try:
+            data = json.loads(line)
+            if not isinstance(data, dict):
+                raise ValueError("expected an object")
+            invalid_keys = set(data) - {'pay', 'x', 'y', 'color'}
+            if invalid_keys:
+                raise ValueError("invalid keys " + " ,".join(invalid_keys))
+            x, y = int(data['x']), int(data['y'])
+            color = str(data['color']).strip().lower()
+            if len(color) != 6 or set(color) - set("0123456789abcdef"):
+                raise ValueError(f"color '{color}' must be 6-char hex, like 'ff8800'")
+            pay = float(data['pay'])
+        except KeyError as e:
+            raise ValueError(f"line {number} is missing {e}")
+        except (ValueError, TypeError) as e:
+            raise ValueError(f"line {number}: {e}")
+        xs.append(x)
+        ys.append(y)
+        colors.append(color)
+        pays.append(pay)
+
+    rgb = np.frombuffer(bytes.fromhex("".join(colors)), dtype=np.uint8).reshape(-1, 3)
+    assert len(rgb) == len(xs)  # or zip() in create_tasks_bulk would pair rows with the wrong colors
+    return np.array(xs, dtype=np.int64), np.array(ys, dtype=np.int64), rgb, np.array(pays, dtype=np.float64)
+
+
+
+def parse_png_tasks(body: bytes, params) -> tuple:
+    """Read a PNG placed at ?x=&y= into (xs, ys, rgb, pays) arrays, one task per visible pixel"""
+    try:
+        left, top, pay = int(params['x']), int(params['y']), float(params['pay'])
+    except KeyError as e:
+        raise ValueError(f"PNG uploads need the {e} query parameter")
+
+    try:
+        image = Image.open(io.BytesIO(body))  # only reads the header, so the size can be checked before decoding
+    except Exception:
+        raise ValueError("the body isn't a readable PNG")
+
+    width, height = image.size
+    if width * height > BULK_TASK_LIMIT:
+        raise ValueError(f"a {width}x{height} image has more than {BULK_TASK_LIMIT} pixels")
+    if left < 0 or top < 0 or left + width > CANVAS_WIDTH or top + height > CANVAS_HEIGHT:
+        raise ValueError(f"a {width}x{height} image at ({left}, {top}) doesn't fit on the {CANVAS_WIDTH}x{CANVAS_HEIGHT} canvas")
+
+    try:
+        image = image.convert("RGBA")
+    except Exception:
+        raise ValueError("the body isn't a readable PNG")
+
+    pixels = np.asarray(image)
+    ys, xs = np.nonzero(pixels[:, :, 3])
+    rgb = np.ascontiguousarray(pixels[ys, xs, :3])
+    return xs.astype(np.int64) + left, ys.astype(np.int64) + top, rgb, np.full(len(xs), pay, dtype=np.float64)
+
+
+RESERVATIONS_CLOSED = "Reservations can no longer be made as pixels has temporarily concluded! Check back later for our reopening."
+
+
 @enforce_auth
+@requires('book')
 async def reserve_task(request):
     authorization = request.headers.get('Authorization', None)
 
     task_id = request.path_params['task_id']
 
-    return JSONResponse("Reservations can no longer be made as pixels has temporarily concluded! Check back later for our reopening.", status_code=404)
+    if not RESERVATIONS_OPEN:
+        return JSONResponse(RESERVATIONS_CLOSED, status_code=404)
+
+    user_id = await authenticate(authorization)
 
-    with orm.db_session():
-        user = User.get_from_authorization(authorization)
+    def reserve():
+        user = User[user_id]
         task = Task.get(id=task_id)
         if not task:
-            return Response(f"Invalid reserve request: task id '{task_id}' does not exist.", status_code=400)
+            raise missing_task(task_id, f"Invalid reserve request: task id '{task_id}' does not exist.")
 
-        if task.completed:
-            return Response(f"That task (id '{task.id}') has already been completed.", status_code=400)
+        if task.status in (COMPLETED, DELETED):
+            raise Rejected(f"That task (id '{task.id}') has already been completed.")
 
-        if task.reservation:
-            return Response(f"That task (id '{task.id}') has already been reserved.", status_code=410)
+        if task.status == RESERVED:
+            raise Rejected(f"That task (id '{task.id}') has already been reserved.", status_code=410)
 
+        record_stats(task, -1)
         task.reservation = user
         task.reservation_expires = datetime.utcnow() + EXPIRATION_OFFSET
-        expiration_task = asyncio.create_task(expire_task(task.id, task.reservation_expires))
-        task.reservation_task_id = reserve_task.NEXT_TASK_ID
-        reserve_task.EXPIRATION_TASKS[task.reservation_task_id] = expiration_task
-        reserve_task.NEXT_TASK_ID += 1
+        task.status = RESERVED
+        record_stats(task)
+        return BookTask(task.id, task.pay, task.x, task.y, task.color), task.reservation_expires
+
+    task, expires = await DB.write(reserve)
+
+    EXPIRY.schedule(task.id, expires)
+    TASK_BOOK.reserve(task, user_id)
 
-    await log("Task reserved!", id=task.id, x=task.x, y=task.y, pay=task.pay, color=task.color, by=user.id)
+    await log("Task reserved!", id=task.id, x=task.x, y=task.y, pay=task.pay, color=task.color, by=user_id)
 
-    return JSONResponse({"id": task.id, "x": task.x, "y": task.y, "color": task.color, "pay": task.pay, "expires": task.reservation_expires.isoformat()+"Z"})
+    return JSONResponse({"id": task.id, "x": task.x, "y": task.y, "color": task.color, "pay": task.pay, "expires": expires.isoformat()+"Z"})
 
-reserve_task.NEXT_TASK_ID = 1
-reserve_task.EXPIRATION_TASKS = {}
+
+MAX_BATCH_RESERVATION = 20
+
+
+def parse_region(region) -> tuple:
+    """Validate a {"x0", "y0", "x1", "y1"} rectangle, covering x0 <= x < x1 and y0 <= y < y1"""
+    if not isinstance(region, dict) or set(region) != {'x0', 'y0', 'x1', 'y1'}:
+        raise Rejected("Invalid region: x0, y0, x1 and y1 must all be given")
+    try:
+        x0, y0, x1, y1 = (int(region[key]) for key in ('x0', 'y0', 'x1', 'y1'))
+    except (TypeError, ValueError):
+        raise Rejected("Invalid region: coordinates must be convertible to integers")
+    if x0 >= x1 or y0 >= y1:
+        raise Rejected("Invalid region: x0 and y0 must be less than x1 and y1")
+    return x0, y0, x1, y1
+
+
+@enforce_auth
+@requires('book')
+async def reserve_tasks(request):
+    authorization = request.headers.get('Authorization', None)
+
+    if not RESERVATIONS_OPEN:
+        return JSONResponse(RESERVATIONS_CLOSED, status_code=404)
+
+    try:
+        data = await request.json()
+    except json.decoder.JSONDecodeError:
+        return Response("Invalid content: your json could not be decoded", status_code=400)
+
+    if not isinstance(data, dict):
+        return Response('Invalid content: expected {"count": count, "minimum_pay": float, "region": optional_region}', status_code=400)
+
+    invalid_keys = set(data) - {'count', 'minimum_pay', 'region'}
+    if invalid_keys:
+        return Response("Invalid keys in data: " + " ,".join(invalid_keys), status_code=400)
+
+    try:
+        count = int(data.get('count', 1))
+    except (TypeError, ValueError):
+        return Response(f"Invalid count '{data['count']}': must be convertible to an integer", status_code=400)
+    if not 1 <= count <= MAX_BATCH_RESERVATION:
+        return Response(f"Invalid count '{count}': must be between 1 and {MAX_BATCH_RESERVATION}", status_code=400)
+
+    try:
+        minimum_pay = float(data.get('minimum_pay') or MINIMUM_WAGE)
+    except (TypeError, ValueError):
+        return Response("Invalid minimum_pay: must be convertible to a number", status_code=400)
+
+    region = parse_region(data['region']) if data.get('region') is not None else None
+
+    user_id = await authenticate(authorization)
+
+    def reserve():
+        user = User[user_id]
+        query = Task.select(lambda t: t.status == OPEN and t.pay >= minimum_pay)
+        if region:
+            x0, y0, x1, y1 = region
+            query = query.filter(lambda t: t.x >= x0 and t.x < x1 and t.y >= y0 and t.y < y1)
+        expires = datetime.utcnow() + EXPIRATION_OFFSET
+        reserved = []
+        for task in query.order_by(lambda t: (orm.desc(t.pay), t.id))[:count]:
+            record_stats(task, -1)
+            task.reservation = user
+            task.reservation_expires = expires
+            task.status = RESERVED
+            record_stats(task)
+            reserved.append(BookTask(task.id, task.pay, task.x, task.y, task.color))
+        return reserved, expires
+
+    reserved, expires = await DB.write(reserve)
+
+    for task in reserved:
+        EXPIRY.schedule(task.id, expires)
+        TASK_BOOK.reserve(task, user_id)
+
+    if reserved:
+        await log("Tasks reserved!", count=len(reserved), tasks=[task.id for task in reserved], by=user_id)
+
+    expires = expires.isoformat() + "Z"
+    return JSONResponse([
+        {"id": task.id, "x": task.x, "y": task.y, "color": task.color, "pay": task.pay, "expires": expires}
+        for task in reserved
+    ])
 
 
 @enforce_auth
 async def balance(request):
     authorization = request.headers.get('Authorization', None)
 
-    with orm.db_session():
-        user = User.get_from_authorization(authorization)
+    user_id, money = await fetch_balance(authorization)
 
-    return JSONResponse({"id": user.id, "balance": user.money})
+    return JSONResponse({"id": user_id, "balance": money})
 
 
 @enforce_auth
@@ -284,10 +1083,16 @@ async def fix_economy(request):
 
     amount = float(await request.body())
 
-    with orm.db_session():
+    def add_money():
+        if not User.exists(id=user_id):
+            raise Rejected(f"User id '{user_id}' does not exist", status_code=404)
         was = User[user_id].money
         new = was + amount
         User[user_id].money = new
+        return was, new
+
+    was, new = await DB.write(add_money)
+    AUTH_CACHE.forget_balance(user_id)
 
     await log("User balance updated:", id=user_id, was=was, now=new, added=amount)
 
@@ -295,111 +1100,758 @@ async def fix_economy(request):
 
 
 @enforce_auth
+@requires('book')
 async def delete_task(request):
     authorization = request.headers.get('Authorization', None)
 
     task_id = request.path_params['task_id']
 
-    with orm.db_session():
-        user = User.get_from_authorization(authorization)
+    magic = authorization.strip() == MAGIC_AUTHORIZATION
+
+    user_id = await authenticate(authorization)
+
+    def delete():
+        user = User[user_id]
         task = Task.get(id=task_id)
-        magic = authorization.strip() == MAGIC_AUTHORIZATION
 
         if not task:
-            return Response(f"Task id '{task_id}' does not exist", status_code=400)
+            raise missing_task(task_id, f"Task id '{task_id}' does not exist")
 
-        if task.completed:
-            return Response(f"Task id '{task_id}' has already been completed", status_code=410)
+        if task.status in (COMPLETED, DELETED):
+            raise Rejected(f"Task id '{task_id}' has already been completed", status_code=410)
 
-        if task.reservation and not magic:
-            return Response(f"Task id '{task_id}' is reserved, so you cannot delete it", status_code=403)
+        if task.status == RESERVED and not magic:
+            raise Rejected(f"Task id '{task_id}' is reserved, so you cannot delete it", status_code=403)
 
         if task.creator != user:
-            return Response(f"Task id '{task_id}' was not created by you", status_code=403)
+            raise Rejected(f"Task id '{task_id}' was not created by you", status_code=403)
 
+        record_stats(task, -1)
         task.deleted = True
         task.completed = user
+        task.status = DELETED
+        task.settled_at = datetime.utcnow()
+        record_stats(task)
         user.money += task.pay
+        return task.pay
+
+    pay = await DB.write(delete)
+    AUTH_CACHE.forget_balance(user_id)
+
+    TASK_BOOK.remove(task_id)
+    EXPIRY.cancel(task_id)
+
+    await log("Task deleted:", id=user_id, task=task_id, created_by=user_id)
+
+    return Response(f"Task id '{task_id}' successfully deleted. You have been refunded the '{pay}' cats you paid for your placement")
+
+
+
+class RateLimit:
+    """Token bucket for one upstream endpoint, refilled from the ratelimit headers pixels sends back"""
+
+    def __init__(self):
+        self.limit = None  # requests per window, unknown until the first response
+        self.period = 0.0  # longest window we've been told about, to refill on our own between responses
+        self.remaining = 1
+        self.resets_at = 0.0  # clock() at which the window refills
+
+    @staticmethod
+    def clock() -> float:
+        return time.monotonic()
+
+    @contextlib.contextmanager
+    def synced(self):
+        """Hold the bucket while reading or changing it. Nobody else can see this one, so there's nothing to do."""
+        yield
+
+    def wait_time(self) -> float:
+        """Seconds until a request can be made, without taking a token"""
+        with self.synced():
+            if self.remaining > 0:
+                return 0
+            return max(self.resets_at - self.clock(), 0)
+
+    async def acquire(self) -> float:
+        """Take a token, returning how long we had to wait for it"""
+        waited = 0.0
+        while True:
+            with self.synced():
+                now = self.clock()
+                if self.remaining <= 0 and now >= self.resets_at:
+                    self.remaining = self.limit or 1
+                    self.resets_at = now + self.period
+                if self.remaining > 0:
+                    self.remaining -= 1
+                    return waited
+                wait = self.resets_at - now
+            waited += wait
+            await asyncio.sleep(wait)
+
+    def update(self, headers):
+        with self.synced():
+            now = self.clock()
+            cooldown_reset = headers.get("cooldown-reset")
+            if cooldown_reset:
+                self.remaining = 0
+                self.resets_at = now + float(cooldown_reset)
+                return
+            if "requests-limit" in headers:
+                self.limit = int(headers["requests-limit"])
+            if "requests-remaining" in headers:
+                self.remaining = int(headers["requests-remaining"])
+            if "requests-reset" in headers:
+                reset = float(headers["requests-reset"])
+                self.period = max(self.period, reset)
+                self.resets_at = now + reset
+
+
+class SharedRateLimit(RateLimit):
+    """A RateLimit whose bucket lives in SHARED_STATE, so every worker process draws on the same budget"""
+
+    def __init__(self, state: 'SharedState', slot: int):
+        super().__init__()
+        self.state = state
+        self.slot = slot
+
+    @staticmethod
+    def clock() -> float:
+        return time.time()  # monotonic clocks don't agree between processes
+
+    @contextlib.contextmanager
+    def synced(self):
+        with self.state.locked():
+            limit, self.period, self.remaining, self.resets_at = self.state.bucket(self.slot)
+            self.limit = limit or None
+            yield
+            self.state.set_bucket(self.slot, self.limit or 0, self.period, self.remaining, self.resets_at)
+
+
+class SharedState:
+    """
+    What the worker processes have to agree on, in a small memory-mapped file: the upstream ratelimit
+    buckets and the canvas size. Every change is made under an flock and bumps the generation counter,
+    so a worker can tell at a glance whether anything moved since it last looked.
+    """
+    HEADER = struct.Struct('<8sQII')  # magic, generation, canvas width, canvas height
+    HEADER_SIZE = 32
+    BUCKET = struct.Struct('<qdqd')  # limit (0 if unknown), period, remaining, resets_at (unix time)
+    MAGIC = b'PXSTATE1'
+    ENDPOINTS = ("/get_pixel", "/get_pixels", "/get_size")  # the ones with a shared bucket
+
+    def __init__(self):
+        self.file = None
+        self.map = None
+
+    def open(self, path: str):
+        size = self.HEADER_SIZE + len(self.ENDPOINTS) * self.BUCKET.size
+        self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), 'r+b')
+        with self.locked():
+            if os.fstat(self.file.fileno()).st_size != size:
+                self.file.truncate(0)
+                self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        with self.locked():
+            if self.HEADER.unpack_from(self.map)[0] != self.MAGIC:
+                self.map[:] = bytes(size)
+                self.HEADER.pack_into(self.map, 0, self.MAGIC, 0, 0, 0)
+
+    def close(self):
+        if self.map is None:
+            return
+        self.map.close()
+        self.file.close()
+        self.map = self.file = None
+
+    @contextlib.contextmanager
+    def locked(self):
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    @property
+    def generation(self) -> int:
+        return self.HEADER.unpack_from(self.map)[1]
+
+    def bump(self, width: Optional[int] = None, height: Optional[int] = None):
+        """Count a change, under the lock, optionally recording a new canvas size"""
+        magic, generation, old_width, old_height = self.HEADER.unpack_from(self.map)
+        self.HEADER.pack_into(self.map, 0, magic, generation + 1, width or old_width, height or old_height)
+
+    def canvas_size(self) -> tuple:
+        """(width, height), or (0, 0) if nobody has set it yet"""
+        return tuple(self.HEADER.unpack_from(self.map)[2:])
+
+    def set_canvas_size(self, width: int, height: int):
+        with self.locked():
+            if self.canvas_size() != (width, height):
+                self.bump(width, height)
+
+    def bucket(self, slot: int) -> tuple:
+        return self.BUCKET.unpack_from(self.map, self.HEADER_SIZE + slot * self.BUCKET.size)
+
+    def set_bucket(self, slot: int, *bucket):
+        if bucket != self.bucket(slot):
+            self.BUCKET.pack_into(self.map, self.HEADER_SIZE + slot * self.BUCKET.size, *bucket)
+            self.bump()
+
+
+SHARED_STATE = SharedState()
+
+
+class Upstream:
+    """The one long-lived, keep-alive connection pool to the pixels API, and the ratelimit budget of each endpoint (shared between workers)"""
+    CONNECTION_LIMIT = 16
+
+    def __init__(self):
+        self.session = None
+        self.ratelimits = defaultdict(RateLimit)  # endpoint -> RateLimit
+
+    async def start(self):
+        for slot, endpoint in enumerate(SHARED_STATE.ENDPOINTS):
+            self.ratelimits[endpoint] = SharedRateLimit(SHARED_STATE, slot)
+        self.session = aiohttp.ClientSession(
+            headers=HEADERS,
+            connector=aiohttp.TCPConnector(limit=self.CONNECTION_LIMIT, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=30),
+        )
 
-    await log("Task deleted:", id=user.id, task=task.id, created_by=task.creator.id)
+    async def close(self):
+        if self.session:
+            await self.session.close()
+            self.session = None
 
-    return Response(f"Task id '{task_id}' successfully deleted. You have been refunded the '{task.pay}' cats you paid for your placement")
+    def wait_time(self, endpoint: str) -> float:
+        return self.ratelimits[endpoint].wait_time()
 
+    @contextlib.asynccontextmanager
+    async def get(self, endpoint: str, **params):
+        """GET an endpoint once its ratelimit allows, yielding the response"""
+        ratelimit = self.ratelimits[endpoint]
+        waited = await ratelimit.acquire()
+        if waited:
+            METRICS.ratelimit_waits[endpoint] += 1
+            METRICS.ratelimit_wait_seconds[endpoint] += waited
+        try:
+            async with self.session.get(API_BASE + endpoint, params=params) as response:
+                METRICS.upstream[endpoint, response.status] += 1
+                ratelimit.update(response.headers)
+                yield response
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+            METRICS.upstream[endpoint, "error"] += 1
+            raise
+
+
+UPSTREAM = Upstream()
 
 
 async def update_canvas():
+    """Fetch the whole canvas into CURRENT_CANVAS, returning it, or None if upstream couldn't be reached"""
     global CURRENT_CANVAS, CANVAS_UPDATED_AT
-    if (CANVAS_UPDATED_AT - datetime.now()).total_seconds() < CANVAS_REFRESH_RATE:
-        CANVAS_UPDATED_AT = datetime.now()
-
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(API_BASE + "/get_pixels", headers=HEADERS) as response:
-                response.raise_for_status()
-                current_pixels_raw = await response.read()
-        print("Got %s pixel fragments", len(current_pixels_raw))
-    except Exception:
-        print(response)
-        await log("Failed to update canvas view:", response=str(response), code=response.status)
+        async with UPSTREAM.get("/get_pixels") as response:
+            response.raise_for_status()
+            current_pixels_raw = await response.read()
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        await log("Failed to update canvas view:", error=str(e) or "Timed out")
         return None
     current_pixels = np.frombuffer(current_pixels_raw, dtype=np.uint8)
     pixels = np.reshape(current_pixels, (CANVAS_HEIGHT, CANVAS_WIDTH, 3))
     CURRENT_CANVAS = pixels
+    CANVAS_UPDATED_AT = datetime.now()
+    CANVAS_HISTORY.append(pixels, time.time())
+    create_erroring_task(settle_from_canvas(pixels))
+    return pixels
 
 
 CURRENT_CANVAS = None
 CANVAS_UPDATED_AT = datetime.now()
-pixel_resets_by = datetime.now()
+
+
+class CanvasHistory:
+    """
+    The last `capacity` canvas frames, in a memory-mapped ring buffer file shared by every worker process.
+
+    Layout: a HEADER, then a float64 unix timestamp per slot, then the height x width x 3 frames.
+    Frames are read straight out of the mapping, so loading the latest one at startup copies nothing.
+    Appends hold an flock on a `.lock` file beside it, and the frame count in the header doubles as the
+    generation counter other workers watch for new frames.
+    """
+    HEADER = struct.Struct('<8sIIIIq')  # magic, width, height, capacity, padding, frames ever appended
+    HEADER_SIZE = 64
+    APPENDED_OFFSET = 24
+    MAGIC = b'PXCANVS2'
+
+    def __init__(self):
+        self.path = None
+        self.lock = None
+        self.file = None
+        self.inode = None
+        self.map = None
+        self.timestamps = None
+        self.frames = None
+        self.appended = 0
+
+    def open(self, path: str, width: int, height: int, capacity: int):
+        """Map the history file, starting it afresh if it's missing or was written for another canvas size"""
+        self.close()
+        self.path = path
+        self.lock = open(path + '.lock', 'a')
+        with self.locked():
+            if not self.attach() or self.frames.shape != (capacity, height, width, 3):
+                self.create(width, height, capacity)
+
+    @contextlib.contextmanager
+    def locked(self):
+        fcntl.flock(self.lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock.fileno(), fcntl.LOCK_UN)
+
+    def attach(self) -> bool:
+        """Map whatever history file is at self.path, returning False if there isn't a usable one"""
+        self.detach()
+        try:
+            file = open(self.path, 'r+b')
+        except FileNotFoundError:
+            return False
+        header = file.read(self.HEADER.size)
+        if len(header) < self.HEADER.size:
+            file.close()
+            return False
+        magic, width, height, capacity, _, appended = self.HEADER.unpack(header)
+        size = self.HEADER_SIZE + capacity * 8 + capacity * height * width * 3
+        if magic != self.MAGIC or os.fstat(file.fileno()).st_size != size:
+            file.close()
+            return False
+        self.file = file
+        self.inode = os.fstat(file.fileno()).st_ino
+        self.map = mmap.mmap(file.fileno(), size)
+        self.appended = appended
+        self.timestamps = np.ndarray((capacity,), dtype='<f8', buffer=self.map, offset=self.HEADER_SIZE)
+        self.frames = np.ndarray((capacity, height, width, 3), dtype=np.uint8, buffer=self.map, offset=self.HEADER_SIZE + capacity * 8)
+        return True
+
+    def create(self, width: int, height: int, capacity: int):
+        """Start an empty history. It's built beside the old file and swapped in, so workers still mapping that one don't fault."""
+        size = self.HEADER_SIZE + capacity * 8 + capacity * height * width * 3
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, 'wb') as file:
+            file.truncate(size)
+            file.write(self.HEADER.pack(self.MAGIC, width, height, capacity, 0, 0))
+        os.replace(temporary, self.path)
+        self.attach()
+
+    def detach(self):
+        # Never map.close(): frames handed out (like CURRENT_CANVAS) still point into it.
+        # The mapping is unmapped once the last of them is gone.
+        self.timestamps = self.frames = None
+        if self.file is not None:
+            self.file.close()
+        self.map = self.file = None
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+        self.detach()
+        if self.lock is not None:
+            self.lock.close()
+            self.lock = None
+
+    def __len__(self):
+        return 0 if self.frames is None else min(self.appended, len(self.frames))
+
+    def stored_appended(self) -> int:
+        return struct.unpack_from('<q', self.map, self.APPENDED_OFFSET)[0]
+
+    def refresh(self) -> bool:
+        """Catch up with frames other workers appended, returning whether there's a newer latest frame"""
+        if self.frames is None:
+            return False
+        try:
+            replaced = os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return False
+        if replaced:  # another worker saw the canvas change size
+            with self.locked():
+                self.attach()
+            return bool(len(self))
+        appended = self.stored_appended()
+        if appended == self.appended:
+            return False
+        self.appended = appended
+        return True
+
+    def append(self, pixels: np.ndarray, when: float):
+        if self.frames is None:
+            return
+        with self.locked():
+            if os.stat(self.path).st_ino != self.inode:
+                self.attach()
+            if pixels.shape != self.frames.shape[1:]:  # the canvas was resized; old frames no longer line up
+                height, width, _ = pixels.shape
+                self.create(width, height, len(self.frames))
+            self.appended = self.stored_appended()
+            slot = self.appended % len(self.frames)
+            self.frames[slot] = pixels
+            self.timestamps[slot] = when
+            self.appended += 1
+            struct.pack_into('<q', self.map, self.APPENDED_OFFSET, self.appended)  # only once the frame is whole
+
+    def slots(self) -> np.ndarray:
+        """Slot numbers from oldest frame to newest"""
+        return np.arange(self.appended - len(self), self.appended) % len(self.frames)
+
+    def latest(self) -> tuple:
+        """(the newest frame, its unix timestamp), or (None, None) if there isn't one"""
+        if not len(self):
+            return None, None
+        slot = (self.appended - 1) % len(self.frames)
+        return self.frames[slot], float(self.timestamps[slot])
+
+    def pixel_at(self, x: int, y: int, when: float) -> tuple:
+        """(hex color of pixel (x, y) in the last frame taken at or before `when`, that frame's timestamp), or (None, None)"""
+        if not len(self):
+            return None, None
+        slots = self.slots()
+        index = np.searchsorted(self.timestamps[slots], when, side='right') - 1
+        if index < 0:
+            return None, None
+        slot = slots[index]
+        return self.frames[slot, y, x].tobytes().hex(), float(self.timestamps[slot])
+
+
+CANVAS_HISTORY = CanvasHistory()
+
+
+class RenderCache:
+    """
+    Keeps the last image a render function made, and its ETag, until the key it was made for changes.
+    With a `min_interval`, a changed key keeps getting the old image until it is that many seconds old.
+    """
+
+    def __init__(self, render, min_interval: float = 0):
+        self.render = render
+        self.min_interval = min_interval
+        self.key = None
+        self.body = None
+        self.etag = None
+        self.rendered_at = 0.0
+        self.pending = None  # the render running in the executor, shared by everyone waiting on it
+
+    def fresh(self, key) -> bool:
+        if self.body is None:
+            return False
+        return key == self.key or time.monotonic() - self.rendered_at < self.min_interval
+
+    def store(self, key, body: bytes):
+        self.body = body
+        # from the content, so it survives restarts and agrees between processes
+        self.etag = '"%s"' % hashlib.blake2b(body, digest_size=12).hexdigest()
+        self.key = key
+        self.rendered_at = time.monotonic()
+
+    def get(self, key, *args) -> tuple:
+        if not self.fresh(key):
+            self.store(key, self.render(*args))
+        return self.body, self.etag
+
+    async def get_in_executor(self, key, snapshot) -> tuple:
+        """Like get(), but renders off the event loop, from the arguments `snapshot()` takes of what it needs"""
+        if not self.fresh(key):
+            if self.pending is None:
+                self.pending = asyncio.get_event_loop().run_in_executor(None, self.render, *snapshot())
+                self.pending.add_done_callback(functools.partial(self.rendered, key))
+            await asyncio.shield(self.pending)
+        return self.body, self.etag
+
+    def rendered(self, key, done: asyncio.Future):
+        self.pending = None
+        if not done.cancelled() and done.exception() is None:
+            self.store(key, done.result())
+
+
+def encode_png(pixels: np.ndarray) -> bytes:
+    output = io.BytesIO()
+    Image.fromarray(pixels).save(output, format="PNG")
+    return output.getvalue()
+
+
+def render_canvas() -> bytes:
+    return encode_png(CURRENT_CANVAS)
+
+
+def render_heatmap(tasks: list, width: int, height: int) -> bytes:
+    """Total pay on offer per pixel, from transparent (nothing) through red and yellow to white (the most)"""
+    demand = np.zeros((height, width), dtype=np.float64)
+    if tasks:
+        xs, ys, pays = np.array([(task.x, task.y, task.pay) for task in tasks]).T
+        xs, ys = xs.astype(np.int64), ys.astype(np.int64)
+        on_canvas = (xs < width) & (ys < height)
+        np.add.at(demand, (ys[on_canvas], xs[on_canvas]), pays[on_canvas])
+    heat = np.sqrt(demand / demand.max()) if demand.any() else demand  # sqrt so the small offers still show
+    pixels = np.empty((height, width, 4), dtype=np.uint8)
+    for channel in range(3):
+        pixels[:, :, channel] = np.clip(heat * 3 - channel, 0, 1) * 255
+    pixels[:, :, 3] = np.where(demand > 0, 255, 0)
+    return encode_png(pixels)
+
+
+CANVAS_RENDER = RenderCache(render_canvas)
+HEATMAP_MIN_INTERVAL = 5  # seconds a busy book waits between heatmap renders, each of which walks every open task
+HEATMAP_RENDER = RenderCache(render_heatmap, HEATMAP_MIN_INTERVAL)
+
+
+def png_response(request, body: bytes, etag: str) -> Response:
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = {tag.strip().lstrip("W/") for tag in request.headers.get("If-None-Match", "").split(",")}
+    if etag in if_none_match or "*" in if_none_match:
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="image/png", headers=headers)
+
+
+async def canvas_png(request):
+    if CURRENT_CANVAS is None:
+        return Response("We haven't seen the canvas yet, please try again shortly.", status_code=503)
+    return png_response(request, *CANVAS_RENDER.get(CANVAS_UPDATED_AT))
+
+
+@requires('book')
+async def heatmap_png(request):
+    key = (TASK_BOOK.version, CANVAS_WIDTH, CANVAS_HEIGHT)
+    heatmap = await HEATMAP_RENDER.get_in_executor(key, lambda: (list(TASK_BOOK.tasks.values()), CANVAS_WIDTH, CANVAS_HEIGHT))
+    return png_response(request, *heatmap)
+
+
+class UpstreamError(Exception):
+    """pixels.pythondiscord.com couldn't answer us"""
+
+
+class PixelVerifier:
+    """
+    Queues the pixel checks for task submissions so that one upstream call can settle many of them.
+
+    Submissions for the same pixel share a single future. A lone submission is looked up with /get_pixel
+    for a fast answer, while a backlog is answered all at once from a fresh /get_pixels canvas.
+    """
+
+    def __init__(self):
+        self.pending = {}  # (x, y) -> future for the hex color of that pixel
+        self.wakeup = None
+        self.worker = None
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        self.worker = create_erroring_task(self.run())
+
+    async def check(self, x: int, y: int) -> str:
+        """The current color of the pixel at x, y as lowercase hex"""
+        future = self.pending.get((x, y))
+        if future is None:
+            future = asyncio.get_event_loop().create_future()
+            self.pending[(x, y)] = future
+            self.wakeup.set()
+        # shielded, since other submitters may be waiting on the same future
+        return await asyncio.shield(future)
+
+    def use_single_lookup(self) -> bool:
+        return len(self.pending) == 1 and not UPSTREAM.wait_time("/get_pixel")
+
+    def ratelimit_wait(self) -> float:
+        """Seconds until we're allowed to answer the pending checks"""
+        if self.use_single_lookup():
+            return 0
+        return UPSTREAM.wait_time("/get_pixels")
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                wait = self.ratelimit_wait()
+                if wait:
+                    # more submissions can pile onto the batch while we wait
+                    await asyncio.sleep(wait)
+                    continue
+                single = self.use_single_lookup()
+                batch, self.pending = self.pending, {}
+                try:
+                    if single:
+                        results = await self.get_pixel(*next(iter(batch)))
+                    else:
+                        results = await self.get_pixels(batch)
+                except UpstreamError as e:
+                    self.fail(batch, e)
+                    continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    # never let one bad batch end the loop, or every later submission would wait forever
+                    print("Pixel verification failed:", repr(e))
+                    self.fail(batch, UpstreamError(repr(e)))
+                    continue
+
+                for coordinates, future in batch.items():
+                    if coordinates not in results:
+                        # ratelimited mid-flight, try again with the next batch
+                        self.pending.setdefault(coordinates, future)
+                    elif not future.done():
+                        future.set_result(results[coordinates])
+
+    @staticmethod
+    def fail(batch: dict, error: UpstreamError):
+        for future in batch.values():
+            if not future.done():
+                future.set_exception(error)
+
+    async def get_pixel(self, x: int, y: int) -> dict:
+        try:
+            async with UPSTREAM.get("/get_pixel", x=x, y=y) as response:
+                if response.headers.get("cooldown-reset"):
+                    await log("Hit the /get_pixel ratelimit", cooldown=response.headers["cooldown-reset"])
+                    return {}
+                response.raise_for_status()
+                data = await response.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise UpstreamError(str(e) or "Timed out") from e
+        return {(x, y): data["rgb"].lower()}
+
+    async def get_pixels(self, batch: dict) -> dict:
+        canvas = await update_canvas()
+        if canvas is None:
+            if UPSTREAM.wait_time("/get_pixels"):
+                return {}
+            raise UpstreamError("Could not fetch the canvas")
+        return {(x, y): bytes(canvas[y, x]).hex() for x, y in batch}
+
+
+PIXEL_VERIFIER = PixelVerifier()
+
+
+def pixels_match(canvas: np.ndarray, xs: np.ndarray, ys: np.ndarray, rgb: np.ndarray) -> np.ndarray:
+    """Whether each pixel on the canvas already has the given color, checked in one vectorized gather"""
+    height, width, _ = canvas.shape
+    in_bounds = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+    matches = np.zeros(len(xs), dtype=bool)
+    matches[in_bounds] = (canvas[ys[in_bounds], xs[in_bounds]] == rgb[in_bounds]).all(axis=1)
+    return matches
+
+
+def find_matching_pixels(canvas: np.ndarray, tasks) -> list:
+    """The ids of the tasks whose pixel on the canvas already has their color"""
+    if not tasks:
+        return []
+    ids = np.fromiter((task.id for task in tasks), dtype=np.int64, count=len(tasks))
+    xs = np.fromiter((task.x for task in tasks), dtype=np.int64, count=len(tasks))
+    ys = np.fromiter((task.y for task in tasks), dtype=np.int64, count=len(tasks))
+    colors = np.frombuffer(bytes.fromhex("".join(task.color for task in tasks)), dtype=np.uint8).reshape(-1, 3)
+    return ids[pixels_match(canvas, xs, ys, colors)].tolist()
+
+
+def flag_satisfied(canvas: np.ndarray):
+    TASK_BOOK.flag_satisfied(find_matching_pixels(canvas, list(TASK_BOOK.tasks.values())))
+
+
+async def settle_from_canvas(canvas: np.ndarray):
+    """
+    Pay out every reserved task whose pixel the canvas shows as done, in one transaction, and flag the open
+    tasks that are already done so nobody is sent to redo them.
+    """
+    reserved = [task for task, _ in TASK_BOOK.reserved.values()]
+    settled_ids = find_matching_pixels(canvas, reserved)
+    flag_satisfied(canvas)
+    if not settled_ids:
+        return
+
+    def settle():
+        settled = []
+        for task_id in settled_ids:
+            task = Task.get(id=task_id)
+            if not task or task.status != RESERVED:
+                continue
+            record_stats(task, -1)
+            task.completed = task.reservation
+            task.status = COMPLETED
+            task.settled_at = datetime.utcnow()
+            record_stats(task)
+            task.reservation.money += task.pay
+            settled.append((task.id, task.reservation.id))
+        return settled
+
+    settled = await DB.write(settle)
+
+    for task_id, user_id in settled:
+        TASK_BOOK.remove(task_id)
+        AUTH_CACHE.forget_balance(user_id)
+        EXPIRY.cancel(task_id)
+    if settled:
+        await log("Pixels completed from the canvas!", count=len(settled), tasks=[task_id for task_id, _ in settled][:25])
 
 
 @enforce_auth
+@requires('ready')
 async def submit_task(request):
-    global pixel_resets_by
     authorization = request.headers.get('Authorization', None)
 
     task_id = request.path_params['task_id']
 
-    with orm.db_session():
-        user = User.get_from_authorization(authorization)
+    user_id = await authenticate(authorization)
+
+    def check():
+        user = User[user_id]
         task = Task.get(id=task_id)
 
         if not task:
-            return Response(f"There is no task with id '{task_id}'", status_code=400)
-
-        if task.reservation and task.reservation != user:
-            return Response("You are not the user who reserved this task", status_code=403)
-
-    if pixel_resets_by - datetime.now() < timedelta(seconds=10):
-        print("Waiting until get_pixel cooldown resets")
-        await asyncio.sleep((pixel_resets_by - datetime.now()).total_seconds())
-    async with aiohttp.ClientSession() as session:
-        async with session.get(API_BASE + "/get_pixel", params={"x": task.x, "y": task.y}, headers=HEADERS) as response:
-            data = await response.json()
-            requests_left = response.headers.get("requests-remaining")
-            requests_reset = response.headers.get("requests-reset")
-            cooldown_reset = response.headers.get("cooldown-reset")
-
-    if cooldown_reset:
-        # fuck
-        pixel_resets_by = datetime.now() + timedelta(seconds=int(cooldown_reset))
-        await log("Hit the fucking /get_pixel ratelimit", remaining=cooldown_reset, requests_left=requests_left, reset=requests_reset)
-        await asyncio.sleep(float(cooldown_reset))
-        # Wait and try again for our user
-        return await submit_task(request)
-
-    if requests_left == "0":
-        pixel_resets_by = datetime.now() + timedelta(seconds=int(requests_reset))
-
-    color = data["rgb"]
+            raise missing_task(task_id, f"There is no task with id '{task_id}'")
+
+        already_paid = task.status == COMPLETED and task.completed == user
+        if task.status in (COMPLETED, DELETED) and not already_paid:
+            raise Rejected(f"Task id '{task_id}' has already been completed", status_code=410)
+
+        if task.status == RESERVED and task.reservation != user:
+            raise Rejected("You are not the user who reserved this task", status_code=403)
+
+        return BookTask(task.id, task.pay, task.x, task.y, task.color), already_paid
+
+    task, already_paid = await DB.read(check)
+    if already_paid:
+        return Response(f"We already saw your pixel on the canvas and paid you {task.pay} cats for it. Thanks!")
+
+    try:
+        color = await PIXEL_VERIFIER.check(task.x, task.y)
+    except UpstreamError:
+        return Response("We couldn't reach pixels to check your pixel, please try again shortly.", status_code=503)
+
     if color == task.color:
         # Success!
-        with orm.db_session():
-            task = Task.get(id=task_id)
-            user = User[user.id]
+        def complete():
+            task = Task[task_id]
+            user = User[user_id]
+            if task.status == COMPLETED and task.completed == user:
+                return False  # settled from the canvas while we were checking
+            if task.status in (COMPLETED, DELETED):
+                raise Rejected(f"Task id '{task_id}' has already been completed", status_code=410)
+            if task.status == RESERVED and task.reservation != user:
+                raise Rejected("You are not the user who reserved this task", status_code=403)
+            record_stats(task, -1)
             task.completed = user
+            task.status = COMPLETED
+            task.settled_at = datetime.utcnow()
+            record_stats(task)
             user.money += task.pay
+            return True
 
-        await log("Pixel completed!", x=task.x, y=task.y, color=task.color, user=user.id)
+        paid_now = await DB.write(complete)
+        AUTH_CACHE.forget_balance(user_id)
+
+        TASK_BOOK.remove(task.id)
+        EXPIRY.cancel(task.id)
+
+        if paid_now:
+            await log("Pixel completed!", x=task.x, y=task.y, color=task.color, user=user_id)
         return Response(f"Congratulations and thank you for your efforts! You have been paid {task.pay} cats for this pixel!")
 
     return Response(f"The pixel at {task.x}, {task.y} appears to currently be {color}, not {task.color}. /get_pixel may take up to a second to update, so feel free to try again. Otherwise someone may have sniped your pixel ;-;. Sorry. Feel free to try again later.", status_code=404)
@@ -408,6 +1860,395 @@ async def submit_task(request):
 db = orm.Database()
 
 
+@db.on_connect(provider='sqlite')
+def sqlite_pragmas(database, connection):
+    # WAL lets the reader threads carry on while the writer commits
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode = WAL')
+    cursor.execute('PRAGMA synchronous = NORMAL')
+    cursor.execute('PRAGMA busy_timeout = 5000')
+    connection.set_trace_callback(count_query)
+
+
+QUERIES = threading.local()  # .count: statements run on this thread's connection, for METRICS
+
+
+def count_query(statement):
+    QUERIES.count = getattr(QUERIES, 'count', 0) + 1
+
+
+class Rejected(Exception):
+    """Raised by a unit of work to turn the request down. Raise it before changing anything."""
+
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+async def rejected_response(request, exc: Rejected):
+    return Response(exc.message, status_code=exc.status_code)
+
+
+class DatabaseExecutor:
+    """
+    Runs units of work off the event loop, so a slow write or fsync never stalls other requests.
+
+    Reads share a small pool of threads, each unit in its own orm.db_session. Writes go through a single
+    writer thread that group commits: whatever arrives within GROUP_COMMIT_WINDOW runs back to back in one
+    transaction, and every caller hears back once it has committed. Units of work are plain functions, so
+    nothing can await while a session is open.
+    """
+    READERS = 4
+    GROUP_COMMIT_WINDOW = 0.003  # seconds
+    MAX_GROUP_SIZE = 512
+
+    def __init__(self):
+        self.readers = ThreadPoolExecutor(self.READERS, thread_name_prefix='db-reader')
+        self.writes = queue.Queue()  # (work, args, loop, future)
+        self.writer = None
+
+    @staticmethod
+    def run(work, args, immediate: bool = False):
+        with orm.db_session(immediate=immediate):
+            return work(*args)
+
+    @staticmethod
+    def counted(work, tally: list):
+        """`work`, adding the number of statements it runs to tally[0]"""
+        def counted_work(*args):
+            before = getattr(QUERIES, 'count', 0)
+            try:
+                return work(*args)
+            finally:
+                tally[0] += getattr(QUERIES, 'count', 0) - before
+        return counted_work
+
+    async def write(self, work, *args):
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_loop, name='db-writer', daemon=True)
+            self.writer.start()
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        tally = [0]
+        started = time.perf_counter()
+        self.writes.put((self.counted(work, tally), args, loop, future))
+        try:
+            return await future
+        finally:
+            METRICS.database('write', time.perf_counter() - started, tally[0])
+
+    def write_loop(self):
+        while True:
+            group = [self.writes.get()]
+            deadline = time.monotonic() + self.GROUP_COMMIT_WINDOW
+            while len(group) < self.MAX_GROUP_SIZE:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    group.append(self.writes.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            for (_, _, loop, future), outcome in zip(group, self.commit_group(group)):
+                loop.call_soon_threadsafe(self.resolve, future, outcome)
+
+    def commit_group(self, group: list) -> list:
+        """Run a group of writes in one transaction, returning (succeeded, result or exception) for each"""
+        outcomes = []
+        try:
+            # BEGIN IMMEDIATE: take the write lock up front, so a write racing another worker process waits
+            # in busy_timeout instead of failing when its read snapshot turns out to be stale
+            with orm.db_session(immediate=True):
+                for work, args, _, _ in group:
+                    try:
+                        outcomes.append((True, work(*args)))
+                    except Rejected as e:
+                        # units reject before changing anything, so the rest of the group is unaffected
+                        outcomes.append((False, e))
+            return outcomes
+        except Exception:
+            if len(group) == 1:
+                return [(False, sys.exc_info()[1])]
+
+        # Something broke part way through and took the whole group down with it,
+        # so run each unit in its own transaction to pin the failure on the right caller
+        outcomes = []
+        for work, args, _, _ in group:
+            try:
+                outcomes.append((True, self.run(work, args, immediate=True)))
+            except Exception as e:
+                outcomes.append((False, e))
+        return outcomes
+
+    @staticmethod
+    def resolve(future: asyncio.Future, outcome: tuple):
+        succeeded, value = outcome
+        if future.cancelled():
+            return
+        if succeeded:
+            future.set_result(value)
+        else:
+            future.set_exception(value)
+
+    async def read(self, work, *args):
+        tally = [0]
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.readers, self.run, self.counted(work, tally), args)
+        finally:
+            METRICS.database('read', time.perf_counter() - started, tally[0])
+
+
+DB = DatabaseExecutor()
+
+
+class Histogram:
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets  # upper bounds, ascending
+        self.counts = [0] * (len(buckets) + 1)  # per bucket, not cumulative; the last is everything above
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+def prometheus_labels(**labels) -> str:
+    escaped = (
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+
+class Metrics:
+    """
+    Counters for /metrics, in Prometheus text format.
+    Everything is updated from the event loop thread with plain dict and list operations, so recording is cheap and lockless.
+    """
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    QUERY_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100)
+
+    def __init__(self):
+        self.requests = defaultdict(int)  # (method, route, status) -> count
+        self.latency = {}  # (method, route) -> Histogram of seconds
+        self.request_db_seconds = {}  # (method, route) -> Histogram of seconds waiting on DB per request
+        self.request_queries = {}  # (method, route) -> Histogram of statements per request
+        self.db_units = defaultdict(int)  # 'read' | 'write' -> units of work
+        self.db_seconds = defaultdict(float)  # 'read' | 'write' -> seconds spent waiting on them
+        self.db_queries = defaultdict(int)  # 'read' | 'write' -> statements run by them
+        self.upstream = defaultdict(int)  # (endpoint, status) -> calls
+        self.ratelimit_waits = defaultdict(int)  # endpoint -> times we slept for its ratelimit
+        self.ratelimit_wait_seconds = defaultdict(float)  # endpoint -> seconds slept
+        self.log_embeds = defaultdict(int)  # 'sent' | 'dropped' | 'failed' | 'ratelimited' -> log embeds (or messages, for ratelimited)
+
+    @staticmethod
+    def histogram(table: dict, key, buckets: tuple) -> Histogram:
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram(buckets)
+        return histogram
+
+    def request(self, method: str, route: str, status: int, seconds: float, db_seconds: float, queries: int):
+        key = (method, route)
+        self.requests[method, route, status] += 1
+        self.histogram(self.latency, key, self.LATENCY_BUCKETS).observe(seconds)
+        self.histogram(self.request_db_seconds, key, self.LATENCY_BUCKETS).observe(db_seconds)
+        self.histogram(self.request_queries, key, self.QUERY_BUCKETS).observe(queries)
+
+    def database(self, kind: str, seconds: float, queries: int):
+        self.db_units[kind] += 1
+        self.db_seconds[kind] += seconds
+        self.db_queries[kind] += queries
+        usage = REQUEST_DATABASE.get()
+        if usage is not None:
+            usage[0] += seconds
+            usage[1] += queries
+
+    def render(self) -> str:
+        lines = []
+
+        def family(name: str, kind: str, description: str):
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histograms(name: str, table: dict, description: str):
+            family(name, "histogram", description)
+            for (method, route), histogram in sorted(table.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{prometheus_labels(method=method, route=route, le=bound)} {cumulative}")
+                labels = prometheus_labels(method=method, route=route)
+                lines.append(f"{name}_sum{labels} {histogram.sum}")
+                lines.append(f"{name}_count{labels} {cumulative}")
+
+        def samples(name: str, kind: str, description: str, table: dict, *label_names):
+            family(name, kind, description)
+            for key, value in sorted(table.items(), key=lambda item: str(item[0])):
+                key = key if isinstance(key, tuple) else (key,)
+                lines.append(f"{name}{prometheus_labels(**dict(zip(label_names, key)))} {value}")
+
+        def gauge(name: str, description: str, value):
+            family(name, "gauge", description)
+            lines.append(f"{name} {value}")
+
+        samples("pixex_requests_total", "counter", "HTTP requests by route and status", self.requests, "method", "route", "status")
+        histograms("pixex_request_duration_seconds", self.latency, "HTTP request latency by route")
+        histograms("pixex_request_db_seconds", self.request_db_seconds, "Time each HTTP request spent waiting on the database")
+        histograms("pixex_request_db_queries", self.request_queries, "SQL statements each HTTP request ran")
+        samples("pixex_db_units_total", "counter", "Database units of work run", self.db_units, "kind")
+        samples("pixex_db_seconds_total", "counter", "Seconds spent waiting on database units of work", self.db_seconds, "kind")
+        samples("pixex_db_queries_total", "counter", "SQL statements run by database units of work", self.db_queries, "kind")
+        samples("pixex_upstream_requests_total", "counter", "Requests to the pixels API by endpoint and status", self.upstream, "endpoint", "status")
+        samples("pixex_upstream_ratelimit_waits_total", "counter", "Times we waited out a pixels API ratelimit", self.ratelimit_waits, "endpoint")
+        samples("pixex_upstream_ratelimit_wait_seconds_total", "counter", "Seconds spent waiting out pixels API ratelimits", self.ratelimit_wait_seconds, "endpoint")
+        samples("pixex_log_embeds_total", "counter", "Log embeds by what became of them", self.log_embeds, "outcome")
+        gauge("pixex_log_queue", "Log embeds waiting to go to discord", len(LOG_DISPATCHER))
+        gauge("pixex_expiry_scheduled", "Reservations waiting to expire", len(EXPIRY))
+        gauge("pixex_tasks_open", "Open tasks in the task book", len(TASK_BOOK))
+        gauge("pixex_tasks_reserved", "Reserved tasks in the task book", len(TASK_BOOK.reserved))
+        gauge("pixex_stream_subscribers", "Connected /tasks/stream subscribers", len(TASK_FEED))
+        gauge("pixex_db_write_queue", "Writes waiting for the database writer thread", DB.writes.qsize())
+        family("pixex_startup_seconds", "gauge", "Seconds after import each startup stage finished")
+        for stage, seconds in STARTUP.finished.items():
+            lines.append(f"pixex_startup_seconds{prometheus_labels(stage=stage)} {seconds}")
+        gauge("pixex_leader", "Whether this worker is the leader", int(LEADER.is_leader))
+        gauge("pixex_change_cursor", "Last change log entry this worker has applied", WORKER_SYNC.cursor)
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+REQUEST_DATABASE = contextvars.ContextVar('REQUEST_DATABASE', default=None)  # [db seconds, queries] of the current request
+
+
+def route_name(scope) -> str:
+    """The path template of the route a request went to, so ids don't each get their own series"""
+    partial = None
+    for route in app.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+        if match == Match.PARTIAL and partial is None:
+            partial = route.path
+    return partial or "unmatched"
+
+
+class MetricsMiddleware:
+    """Records latency, status, database time and statement count of every HTTP request by route"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        usage = [0.0, 0]
+        token = REQUEST_DATABASE.set(usage)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_DATABASE.reset(token)
+            METRICS.request(scope["method"], route_name(scope), status, time.perf_counter() - started, *usage)
+
+
+async def healthz(request):
+    """Whether the process is up and serving at all"""
+    return Response("ok")
+
+
+async def readyz(request):
+    """Whether every startup stage is done, and how long after STARTED_AT each one finished"""
+    ready = STARTUP.done('ready')
+    waiting = [stage for stage in STARTUP.STAGES if not STARTUP.done(stage)]
+    return JSONResponse({"ready": ready, "stages": STARTUP.finished, "waiting": waiting}, status_code=200 if ready else 503)
+
+
+async def metrics(request):
+    return Response(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+
+class AuthCache:
+    """
+    Bounded LRU of authorization token -> user id, so authenticated requests skip the identifier lookup.
+
+    Balances are cached beside it for GET /balance, and forgotten whenever a write changes them.
+    """
+    SIZE = 10_000
+
+    def __init__(self):
+        self.users = OrderedDict()  # identifier -> user id
+        self.balances = {}  # user id -> money
+        self.version = 0  # bumped whenever a balance is forgotten, so reads that raced a write aren't cached
+
+    def get(self, identifier: str) -> Optional[int]:
+        user_id = self.users.get(identifier)
+        if user_id is not None:
+            self.users.move_to_end(identifier)
+        return user_id
+
+    def put(self, identifier: str, user_id: int, money: Optional[float] = None, version: Optional[int] = None):
+        self.users[identifier] = user_id
+        self.users.move_to_end(identifier)
+        if money is not None and version == self.version:
+            self.balances[user_id] = money
+        while len(self.users) > self.SIZE:
+            _, evicted = self.users.popitem(last=False)
+            self.balances.pop(evicted, None)
+
+    def forget_balance(self, user_id: int):
+        self.balances.pop(user_id, None)
+        self.version += 1
+
+
+AUTH_CACHE = AuthCache()
+
+
+async def lookup_user(identifier: str) -> tuple:
+    version = AUTH_CACHE.version
+
+    def lookup():
+        user = User.get(identifier=identifier)
+        return user and (user.id, user.money)
+
+    def create():
+        user = User.upsert(identifier)
+        return user.id, user.money
+
+    user_id, money = await DB.read(lookup) or await DB.write(create)
+    AUTH_CACHE.put(identifier, user_id, money, version)
+    return user_id, money
+
+
+async def authenticate(authorization: str) -> int:
+    """The id of the user behind an authorization token, creating them on first sight"""
+    identifier = authorization.strip()
+    user_id = AUTH_CACHE.get(identifier)
+    if user_id is None:
+        user_id, _ = await lookup_user(identifier)
+    return user_id
+
+
+async def fetch_balance(authorization: str) -> tuple:
+    """The (id, balance) of the user behind an authorization token"""
+    identifier = authorization.strip()
+    user_id = AUTH_CACHE.get(identifier)
+    if user_id is not None and user_id in AUTH_CACHE.balances:
+        return user_id, AUTH_CACHE.balances[user_id]
+    return await lookup_user(identifier)
+
+
 class User(db.Entity):
     id = orm.PrimaryKey(int, auto=True)
     identifier = orm.Required(str, index=True, unique=True)
@@ -416,15 +2257,27 @@ class User(db.Entity):
     requested_tasks = orm.Set('Task', reverse='reservation')
     created_tasks = orm.Set('Task', reverse='creator')
     completed_tasks = orm.Set('Task', reverse='completed')
+    stats = orm.Optional('Stats')
 
     @classmethod
-    def get_from_authorization(cls, authorization: str) -> 'User':
-        authorization = authorization.strip()
-        user = cls.get(identifier=authorization)
-        if not user and authorization == MAGIC_AUTHORIZATION:
-            # initial user seed
-            return cls(identifier=authorization, money=30)
-        return user or cls(identifier=authorization)
+    def upsert(cls, identifier: str) -> 'User':
+        """
+        Fetch the user for an identifier, creating them if needed.
+
+        The insert is an INSERT OR IGNORE, so two first requests from the same token can't trip the unique index.
+        """
+        user = cls.get(identifier=identifier)
+        if user:
+            return user
+        money = 30 if identifier == MAGIC_AUTHORIZATION else 0  # initial user seed
+        db.execute('INSERT OR IGNORE INTO "User" ("identifier", "money", "total_tasks") VALUES ($identifier, $money, 0)')
+        return cls.get(identifier=identifier)
+
+
+OPEN = 'open'
+RESERVED = 'reserved'
+COMPLETED = 'completed'
+DELETED = 'deleted'
 
 
 class Task(db.Entity):
@@ -438,46 +2291,745 @@ class Task(db.Entity):
     pay = orm.Required(float)
     reservation = orm.Optional(User)
     reservation_expires = orm.Optional(datetime)
-    reservation_task_id = orm.Optional(int)  # name of the asyncio task we use to cancel auto-expire
+    # open/reserved/completed/deleted, mirroring the columns above so the hot queries can use one index
+    status = orm.Required(str, default=OPEN)
+    settled_at = orm.Optional(datetime)  # when it was completed or deleted, for the archive retention
 
 
-async def start_database():
-    db.bind(provider='sqlite', filename='data.db', create_db=True)
-    db.generate_mapping(create_tables=True)
-
-    with orm.db_session():
-        task_expiration_checks = orm.select(task for task in Task if task.reservation)
-        for task in task_expiration_checks:
-            assert task.reservation_expires is not None
-            assert task.reservation_task_id is not None
-            if task.reservation_expires < datetime.now():
-                task.reservation = None
-                task.reservation_expires = None
-                task.reservation_task_id = None
-            else:
-                create_erroring_task(expire_task(task.id, task.reservation_expires))
+class ArchivedTask(db.Entity):
+    """Settled tasks moved out of Task by the compaction job. Only ever appended to."""
+    id = orm.PrimaryKey(int)  # the id it had as a Task
+    creator = orm.Required(int, index=True)
+    completed = orm.Optional(int, index=True)
+    reservation = orm.Optional(int)
+    x = orm.Required(int)
+    y = orm.Required(int)
+    color = orm.Required(str)
+    pay = orm.Required(float)
+    status = orm.Required(str)
+    settled_at = orm.Optional(datetime)
+    archived_at = orm.Required(datetime)
+
+    def as_task(self) -> 'SettledTask':
+        """A stand-in with the attributes stat_contributions() reads, so archived tasks still count in rebuild_stats()"""
+        return SettledTask(
+            status=self.status,
+            pay=self.pay,
+            creator=User[self.creator],
+            completed=self.completed and User[self.completed],
+            reservation=self.reservation and User[self.reservation],
+        )
 
 
-async def expire_task(task_id: int, when: datetime):
-    time_to_sleep = (when - datetime.utcnow()).total_seconds()
-    await asyncio.sleep(max(time_to_sleep, 0))
-    with orm.db_session():
-        task = Task[task_id]
-        if not task.completed:
-            reserver = task.reservation
+SettledTask = namedtuple('SettledTask', 'status pay creator completed reservation')
+
+
+def missing_task(task_id: int, message: str) -> Rejected:
+    """The rejection for a task id that isn't in Task, which may just have been archived"""
+    if ArchivedTask.exists(id=task_id):
+        return Rejected(f"Task id '{task_id}' has already been completed", status_code=410)
+    return Rejected(message)
+
+
+class Stats(db.Entity):
+    """Running counters behind GET /tasks/stats. The row without a user holds the global counters."""
+    id = orm.PrimaryKey(int, auto=True)
+    user = orm.Optional(User, unique=True)
+    # global
+    available = orm.Required(int, default=0)
+    all_completed = orm.Required(int, default=0)
+    all_reserved = orm.Required(int, default=0)
+    # per user, as the worker
+    reserved = orm.Required(int, default=0)
+    completed = orm.Required(int, default=0)
+    total_earnings = orm.Required(float, default=0)
+    # per user, as the creator
+    submitted = orm.Required(int, default=0)
+    services_provided = orm.Required(int, default=0)
+    paid = orm.Required(float, default=0)
+    waiting = orm.Required(int, default=0)
+    waiting_payments = orm.Required(float, default=0)
+    deleted = orm.Required(int, default=0)
+
+    GLOBAL_COUNTERS = ('available', 'all_completed', 'all_reserved')
+    USER_COUNTERS = ('total_earnings', 'completed', 'reserved', 'submitted', 'services_provided', 'paid', 'waiting_payments', 'waiting', 'deleted')
+
+    @classmethod
+    def of(cls, user: Optional[User]) -> 'Stats':
+        if user is None:
+            return cls.get(user=None) or cls(user=None)
+        return user.stats or cls(user=user)  # through the relationship, which the session caches
+
+    def to_global_dict(self) -> dict:
+        return {counter: getattr(self, counter) for counter in self.GLOBAL_COUNTERS}
+
+    def to_user_dict(self) -> dict:
+        response = {"average_pay": self.total_earnings / self.completed if self.completed else None}
+        response.update((counter, getattr(self, counter)) for counter in self.USER_COUNTERS)
+        return response
+
+    @classmethod
+    def empty_user_dict(cls) -> dict:
+        response = {"average_pay": None}
+        response.update((counter, 0) for counter in cls.USER_COUNTERS)
+        return response
+
+
+class Change(db.Entity):
+    """
+    A task's status or a user's balance changed. Appended by the triggers in create_triggers(), so every worker
+    process can replay the others' writes onto its own TaskBook, ExpiryScheduler and AuthCache.
+    """
+    id = orm.PrimaryKey(int, auto=True)
+    kind = orm.Required(str)  # 'task' | 'user'
+    ref = orm.Required(int)  # the task or user id
+    at = orm.Required(datetime, sql_default='CURRENT_TIMESTAMP')
+
+
+class Lease(db.Entity):
+    """A role only one worker process may hold at a time, for as long as it keeps renewing it"""
+    name = orm.PrimaryKey(str)
+    holder = orm.Required(str)  # a WORKER_ID
+    expires = orm.Required(datetime)
+
+
+def stat_contributions(task: Task):
+    """Yield the (user, counter, amount) a task adds to the stats in its current state. A user of None is the global row."""
+    status = task.status
+    creator = task.creator
+    yield creator, 'submitted', 1
+    if status == OPEN:
+        yield None, 'available', 1
+        yield creator, 'waiting', 1
+        yield creator, 'waiting_payments', task.pay
+    elif status == RESERVED:
+        yield None, 'all_reserved', 1
+        yield task.reservation, 'reserved', 1
+    elif status == COMPLETED:
+        yield None, 'all_completed', 1
+        yield task.completed, 'completed', 1
+        yield task.completed, 'total_earnings', task.pay
+        yield creator, 'services_provided', 1
+        yield creator, 'paid', task.pay
+    else:
+        yield creator, 'deleted', 1
+
+
+def record_stats(task: Task, sign: int = 1):
+    """
+    Add a task's contribution to the running stats, or take it back with sign=-1.
+
+    State changes are bracketed: record_stats(task, -1), change the task, record_stats(task).
+    """
+    for user, counter, amount in stat_contributions(task):
+        stats = Stats.of(user)
+        setattr(stats, counter, getattr(stats, counter) + sign * amount)
+
+
+def tally_stats(totals: defaultdict, task: Task, sign: int = 1):
+    """record_stats(), but into `totals` ((user, counter) -> amount), for apply_stats() to write once for a whole batch"""
+    for user, counter, amount in stat_contributions(task):
+        totals[user, counter] += sign * amount
+
+
+def apply_stats(totals: dict):
+    for (user, counter), amount in totals.items():
+        if amount:
+            stats = Stats.of(user)
+            setattr(stats, counter, getattr(stats, counter) + amount)
+
+
+def record_open_tasks(creator: User, count: int, total_pay: float):
+    """record_stats() for a batch of new open tasks from one creator, applied in one go"""
+    Stats.of(None).available += count
+    stats = Stats.of(creator)
+    stats.submitted += count
+    stats.waiting += count
+    stats.waiting_payments += total_pay
+
+
+def stats_queries(user: Optional[User] = None) -> dict:
+    """The queries behind scan_stats(), as counter -> (query, aggregate)"""
+    queries = {
+        "available": (orm.select(task for task in Task if task.status == OPEN), 'count'),
+        "all_completed": (orm.select(task for task in Task if task.status == COMPLETED), 'count'),
+        "all_reserved": (orm.select(task for task in Task if task.status == RESERVED), 'count'),
+    }
+
+    if user:
+        queries.update({
+            "total_earnings": (orm.select(task.pay for task in Task if task.completed == user and task.status == COMPLETED), 'sum'),
+            "completed": (orm.select(task for task in Task if task.completed == user and task.status == COMPLETED), 'count'),
+            "reserved": (orm.select(task for task in Task if task.reservation == user and task.status == RESERVED), 'count'),
+            "submitted": (orm.select(task for task in Task if task.creator == user), 'count'),
+            "services_provided": (orm.select(task for task in Task if task.creator == user and task.status == COMPLETED), 'count'),
+            "paid": (orm.select(task.pay for task in Task if task.creator == user and task.status == COMPLETED), 'sum'),
+            "waiting_payments": (orm.select(task.pay for task in Task if task.creator == user and task.status == OPEN), 'sum'),
+            "waiting": (orm.select(task for task in Task if task.creator == user and task.status == OPEN), 'count'),
+            "deleted": (orm.select(task for task in Task if task.creator == user and task.status == DELETED), 'count'),
+        })
+    return queries
+
+
+def archived_stats_queries(user: Optional[User] = None) -> dict:
+    """What the archived tasks add to stats_queries(), in the same shape"""
+    queries = {
+        "all_completed": (orm.select(task for task in ArchivedTask if task.status == COMPLETED), 'count'),
+    }
+
+    if user:
+        queries.update({
+            "total_earnings": (orm.select(task.pay for task in ArchivedTask if task.completed == user.id and task.status == COMPLETED), 'sum'),
+            "completed": (orm.select(task for task in ArchivedTask if task.completed == user.id and task.status == COMPLETED), 'count'),
+            "submitted": (orm.select(task for task in ArchivedTask if task.creator == user.id), 'count'),
+            "services_provided": (orm.select(task for task in ArchivedTask if task.creator == user.id and task.status == COMPLETED), 'count'),
+            "paid": (orm.select(task.pay for task in ArchivedTask if task.creator == user.id and task.status == COMPLETED), 'sum'),
+            "deleted": (orm.select(task for task in ArchivedTask if task.creator == user.id and task.status == DELETED), 'count'),
+        })
+    return queries
+
+
+def scan_stats(user: Optional[User] = None) -> dict:
+    """Compute the stats the slow way with full scans, to check or rebuild the running counters"""
+    response = {counter: getattr(query, aggregate)() for counter, (query, aggregate) in stats_queries(user).items()}
+    for counter, (query, aggregate) in archived_stats_queries(user).items():
+        response[counter] += getattr(query, aggregate)()
+    if user:
+        response["average_pay"] = response["total_earnings"] / response["completed"] if response["completed"] else None
+    return response
+
+
+def open_tasks_by_pay():
+    return orm.select(task for task in Task if task.status == OPEN).order_by(orm.desc(Task.pay))
+
+
+def live_reservations():
+    return orm.select(task for task in Task if task.status == RESERVED)
+
+
+def reservations_after(task_id: int):
+    return orm.select(task for task in Task if task.status == RESERVED and task.id > task_id).order_by(Task.id)
+
+
+def explain_queries() -> dict:
+    """EXPLAIN QUERY PLAN for each hot query, as name -> plan lines, to check they're served from an index"""
+    user = User.select().first() or User(identifier='explain-queries')  # only for its id, rolled back below
+    orm.flush()
+    queries = {
+        "open tasks by pay": open_tasks_by_pay(),
+        "live reservations": live_reservations(),
+        "reservations after": reservations_after(0),
+    }
+    queries.update((counter, query) for counter, (query, _) in stats_queries(user).items())
+
+    plans = {}
+    for name, query in queries.items():
+        sql = query.get_sql()
+        # the values don't change the plan, only how many there are
+        rows = db.get_connection().execute("EXPLAIN QUERY PLAN " + sql, [OPEN] * sql.count("?")).fetchall()
+        plans[name] = [row[-1] for row in rows]
+    orm.rollback()
+    return plans
+
+
+def full_scans(plans: dict) -> list:
+    """The names of the queries whose plan scans the whole Task table"""
+    return [name for name, lines in plans.items() if any(line.startswith("SCAN") and "USING" not in line for line in lines)]
+
+
+def rebuild_stats():
+    """Throw away the running counters and recount them from every task"""
+    orm.delete(stats for stats in Stats)
+    Stats(user=None)
+    for task in Task.select():
+        record_stats(task)
+    for task in ArchivedTask.select():
+        record_stats(task.as_task())
+
+
+def verify_stats() -> list:
+    """Compare the running counters against a full scan, returning (user id, counter, running, scanned) for each mismatch"""
+    mismatches = []
+    for user in [None] + list(User.select()):
+        stats = Stats.get(user=user)
+        running = stats.to_global_dict() if user is None else stats.to_user_dict() if stats else Stats.empty_user_dict()
+        scanned = scan_stats(user)
+        for counter, value in running.items():
+            expected = scanned[counter]
+            if value != expected and not (value is not None and expected is not None and abs(value - expected) < 1e-6):
+                mismatches.append((user and user.id, counter, value, expected))
+    return mismatches
+
+
+def bind_database():
+    # worker processes start side by side, and only one at a time may migrate or create tables
+    with open(DATABASE_FILE + '.lock', 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        migrate_database()
+        db.bind(provider='sqlite', filename=DATABASE_FILE, create_db=True)
+        db.generate_mapping(create_tables=True)
+        create_indexes()
+        create_triggers()
+
+
+def migrate_database():
+    """Bring an existing data.db up to date with the entities, before Pony checks the tables"""
+    connection = sqlite3.connect(DATABASE_FILE)
+    with connection:
+        columns = {row[1] for row in connection.execute('PRAGMA table_info("Task")')}
+        if columns and "settled_at" not in columns:
+            # left empty on old rows, which the compaction job then treats as long settled
+            print("Migrating: adding Task.settled_at")
+            connection.execute('ALTER TABLE "Task" ADD COLUMN "settled_at" DATETIME')
+        if columns and "status" not in columns:
+            print("Migrating: adding Task.status")
+            connection.execute('ALTER TABLE "Task" ADD COLUMN "status" TEXT NOT NULL DEFAULT \'open\'')
+            connection.execute("""
+                UPDATE "Task" SET "status" = CASE
+                    WHEN "deleted" THEN 'deleted'
+                    WHEN "completed" IS NOT NULL THEN 'completed'
+                    WHEN "reservation" IS NOT NULL THEN 'reserved'
+                    ELSE 'open'
+                END
+            """)
+    connection.close()
+
+
+def create_indexes():
+    # Pony's composite_index can't do DESC, so these are kept by hand
+    connection = sqlite3.connect(DATABASE_FILE)
+    with connection:
+        connection.execute('CREATE INDEX IF NOT EXISTS "idx_task__status_pay" ON "Task" ("status", "pay" DESC)')
+        connection.execute('CREATE INDEX IF NOT EXISTS "idx_task__creator_status" ON "Task" ("creator", "status")')
+        connection.execute('CREATE INDEX IF NOT EXISTS "idx_task__reservation_status" ON "Task" ("reservation", "status")')
+        connection.execute('CREATE INDEX IF NOT EXISTS "idx_task__status_id" ON "Task" ("status", "id")')
+        connection.execute('CREATE INDEX IF NOT EXISTS "idx_task__x_y" ON "Task" ("x", "y")')
+    connection.close()
+
+
+def create_triggers():
+    connection = sqlite3.connect(DATABASE_FILE)
+    with connection:
+        connection.execute("""
+            CREATE TRIGGER IF NOT EXISTS "trg_task__insert_change" AFTER INSERT ON "Task"
+            BEGIN INSERT INTO "Change" ("kind", "ref") VALUES ('task', NEW."id"); END
+        """)
+        connection.execute("""
+            CREATE TRIGGER IF NOT EXISTS "trg_task__status_change" AFTER UPDATE OF "status" ON "Task"
+            WHEN OLD."status" != NEW."status"
+            BEGIN INSERT INTO "Change" ("kind", "ref") VALUES ('task', NEW."id"); END
+        """)
+        connection.execute("""
+            CREATE TRIGGER IF NOT EXISTS "trg_user__money_change" AFTER UPDATE OF "money" ON "User"
+            WHEN OLD."money" != NEW."money"
+            BEGIN INSERT INTO "Change" ("kind", "ref") VALUES ('user', NEW."id"); END
+        """)
+    connection.close()
+
+
+def open_book_tasks() -> list:
+    # straight from the columns, since making an entity for every open task is most of the cost of startup
+    return [BookTask(*row) for row in db.select('SELECT "id", "pay", "x", "y", "color" FROM "Task" WHERE "status" = $OPEN')]
+
+
+def load_book() -> tuple:
+    """(open BookTasks, (BookTask, reserver id, expiry) for each live reservation)"""
+    return (
+        open_book_tasks(),
+        [
+            (BookTask(task.id, task.pay, task.x, task.y, task.color), task.reservation.id, task.reservation_expires)
+            for task in live_reservations()
+        ],
+    )
+
+
+def restock_book(open_tasks: list, reserved_tasks: list):
+    TASK_BOOK.rebuild(open_tasks, [(task, user_id) for task, user_id, _ in reserved_tasks])
+    for task, _, when in reserved_tasks:
+        EXPIRY.schedule(task.id, when)
+
+
+def latest_change() -> int:
+    # from the AUTOINCREMENT counter rather than MAX("id"), which drops to nothing once every change is pruned
+    # while new ids carry on from the old count, and would look like changes we missed
+    return (db.select("""SELECT "seq" FROM "sqlite_sequence" WHERE "name" = 'Change'""") or [0])[0]
+
+
+def load_open_book() -> tuple:
+    """(the change log position to follow the other workers from, open BookTasks), as of the same snapshot"""
+    return latest_change(), open_book_tasks()
+
+
+RECOVERY_BATCH_SIZE = 1000  # reservations recovered per transaction at startup
+
+
+def recover_reservations(after: int) -> tuple:
+    """
+    Go through the next batch of reservations after task id `after`, putting the expired ones back on offer.
+    Returns (released BookTasks, (BookTask, reserver id, expiry) for each live one, the id to carry on after or None when done)
+    """
+    tasks = reservations_after(after)[:RECOVERY_BATCH_SIZE]
+    now = datetime.utcnow()
+    released = []
+    live = []
+    totals = defaultdict(int)
+    for task in tasks:
+        assert task.reservation_expires is not None
+        book_task = BookTask(task.id, task.pay, task.x, task.y, task.color)
+        if task.reservation_expires < now:
+            tally_stats(totals, task, -1)
             task.reservation = None
             task.reservation_expires = None
-            if task.reservation_task_id in reserve_task.EXPIRATION_TASKS:
-                task_task = reserve_task.EXPIRATION_TASKS[task.reservation_task_id]
-                del reserve_task.EXPIRATION_TASKS[task.reservation_task_id]
-                task_task.cancel()
-            task.reservation_task_id = None
+            task.status = OPEN
+            tally_stats(totals, task)
+            released.append(book_task)
         else:
-            print("Successfully completed while we waited")
-            return  # Successfully completed while we waited
+            live.append((book_task, task.reservation.id, task.reservation_expires))
+    apply_stats(totals)
+    return released, live, tasks[-1].id if len(tasks) == RECOVERY_BATCH_SIZE else None
 
-    await log("Task reservation expired", id=task.id, x=task.x, y=task.y, pay=task.pay, color=task.color, by=reserver)
 
+async def start_database():
+    """Just bind it; warm_up() loads the task book once we're serving"""
+    bind_database()
+
+    def ensure_stats():
+        if not Stats.get(user=None):
+            rebuild_stats()
+
+    await DB.write(ensure_stats)
+
+
+def import_dependencies():
+    """Import everything LazyModule put off, meant for a thread so the event loop keeps serving meanwhile"""
+    for module in (aiohttp, np, Image):
+        importlib.import_module(module.name)
+
+
+async def warm_up():
+    """The rest of startup, run once we're already serving. See Startup for what each stage makes work."""
+    WORKER_SYNC.cursor, open_tasks = await DB.read(load_open_book)
+    TASK_BOOK.rebuild(open_tasks)
+    STARTUP.finish('book')
+
+    after = 0
+    while after is not None:
+        released, live, after = await DB.write(recover_reservations, after)
+        released = [task for task in released if task.id not in TASK_BOOK.tasks and task.id not in TASK_BOOK.reserved]
+        if released:
+            TASK_BOOK.add_many(released)
+        if live:
+            TASK_BOOK.restore_reserved([(task, user_id) for task, user_id, _ in live])
+        for task, _, when in live:
+            EXPIRY.schedule(task.id, when)
+    STARTUP.finish('reservations')
+
+    await asyncio.get_event_loop().run_in_executor(None, import_dependencies)
+    for start in (
+        load_canvas_history, start_upstream, start_verifier, start_expiry, start_leadership, start_sync,
+        start_canvas_loop, start_compaction, start_size_loop,
+    ):
+        await start()
+    STARTUP.finish('ready')
+    await log("Server is ready", **{stage: f"{seconds}s" for stage, seconds in STARTUP.finished.items()})
+
+
+class ExpiryScheduler:
+    """
+    Releases expired reservations from a single timer, rather than a sleeping coroutine per reservation.
+
+    Deadlines are kept in a heap. Cancelling only forgets the deadline, and its heap entry is thrown away
+    when it reaches the top.
+    """
+
+    RETRY_DELAY = 1  # seconds to wait after a failed release
+
+    def __init__(self):
+        self.heap = []  # (when, task id), possibly stale
+        self.deadlines = {}  # task id -> when, for every reservation we're still watching
+        self.wakeup = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def start(self):
+        self.wakeup = asyncio.Event()
+        create_erroring_task(self.run())
+
+    def schedule(self, task_id: int, when: datetime):
+        self.deadlines[task_id] = when
+        heapq.heappush(self.heap, (when, task_id))
+        if self.wakeup and self.heap[0] == (when, task_id):
+            self.wakeup.set()
+
+    def cancel(self, task_id: int):
+        self.deadlines.pop(task_id, None)
+
+    def next_deadline(self) -> Optional[datetime]:
+        while self.heap:
+            when, task_id = self.heap[0]
+            if self.deadlines.get(task_id) == when:
+                return when
+            heapq.heappop(self.heap)
+        return None
+
+    def pop_due(self, now: datetime) -> list:
+        due = []
+        while True:
+            when = self.next_deadline()
+            if when is None or when > now:
+                return due
+            _, task_id = heapq.heappop(self.heap)
+            del self.deadlines[task_id]
+            due.append(task_id)
+
+    async def run(self):
+        while True:
+            if not LEADER.is_leader:
+                # every worker keeps the deadlines, so any of them can take over, but only the leader releases
+                await asyncio.sleep(Leadership.RENEW_INTERVAL)
+                continue
+            self.wakeup.clear()
+            when = self.next_deadline()
+            timeout = None if when is None else max((when - datetime.utcnow()).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            now = datetime.utcnow()
+            due = self.pop_due(now)
+            if not due:
+                continue
+            try:
+                await release_reservations(due)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # the database stayed locked past busy_timeout, say; put them back and retry
+                print("Could not release expired reservations:", repr(e))
+                for task_id in due:
+                    if task_id not in self.deadlines:
+                        self.schedule(task_id, now)
+                await asyncio.sleep(self.RETRY_DELAY)
+
+
+EXPIRY = ExpiryScheduler()
+
+
+async def release_reservations(task_ids: list):
+    """Put the given reservations back on offer in one transaction, skipping any that were settled meanwhile"""
+    def release():
+        released = []
+        later = []  # reserved again since we scheduled them
+        now = datetime.utcnow()
+        for task_id in task_ids:
+            task = Task.get(id=task_id)
+            if not task or task.status != RESERVED:
+                continue  # Successfully completed while we waited
+            if task.reservation_expires > now:
+                later.append((task.id, task.reservation_expires))
+                continue
+            reserver = task.reservation
+            record_stats(task, -1)
+            task.reservation = None
+            task.reservation_expires = None
+            task.status = OPEN
+            record_stats(task)
+            released.append((BookTask(task.id, task.pay, task.x, task.y, task.color), reserver.id))
+        return released, later
+
+    released, later = await DB.write(release)
+
+    for task, _ in released:
+        TASK_BOOK.add(task)
+    for task_id, when in later:
+        EXPIRY.schedule(task_id, when)
+
+    if len(released) == 1:
+        task, reserver = released[0]
+        await log("Task reservation expired", id=task.id, x=task.x, y=task.y, pay=task.pay, color=task.color, by=reserver)
+    elif released:
+        await log("Task reservations expired", count=len(released), tasks=[task.id for task, _ in released][:25])
+
+
+def claim_lease(name: str, holder: str, term: timedelta) -> bool:
+    """Take or renew a Lease, returning whether `holder` now has it"""
+    now = datetime.utcnow()
+    lease = Lease.get(name=name)
+    if lease is None:
+        Lease(name=name, holder=holder, expires=now + term)
+        return True
+    if lease.holder != holder and lease.expires > now:
+        return False
+    lease.holder = holder
+    lease.expires = now + term
+    return True
+
+
+def resign_lease(name: str, holder: str):
+    lease = Lease.get(name=name)
+    if lease and lease.holder == holder:
+        lease.expires = datetime.utcnow()
+
+
+class Leadership:
+    """
+    Elects the one worker process that runs the jobs there must only be one of: releasing expired reservations,
+    refreshing the canvas and its size, archiving, and pruning the change log.
+
+    The leader holds the 'leader' Lease and renews it every RENEW_INTERVAL. If it stops, another worker
+    takes over once the lease runs out. We stop acting as leader well before our lease could have.
+    """
+    LEASE = 'leader'
+    TERM = timedelta(seconds=10)
+    RENEW_INTERVAL = 2  # seconds
+
+    def __init__(self):
+        self.held_until = 0.0  # time.monotonic() we may act as leader until
+
+    @property
+    def is_leader(self) -> bool:
+        return time.monotonic() < self.held_until
+
+    def start(self):
+        create_erroring_task(self.run())
+
+    async def run(self):
+        while True:
+            renewing = time.monotonic()
+            try:
+                held = await DB.write(claim_lease, self.LEASE, WORKER_ID, self.TERM)
+            except Exception as e:  # the database stayed locked past busy_timeout; try again next round
+                print("Could not renew the leader lease:", e)
+                held = False
+            was_leader = self.is_leader
+            self.held_until = renewing + self.TERM.total_seconds() / 2 if held else 0.0
+            if held != was_leader:
+                await log("This worker is now the leader" if held else "This worker is no longer the leader", worker=WORKER_ID)
+            await asyncio.sleep(self.RENEW_INTERVAL)
+
+    async def resign(self):
+        """Hand the lease back on shutdown, so another worker needn't wait out the term"""
+        if self.is_leader:
+            self.held_until = 0.0
+            await DB.write(resign_lease, self.LEASE, WORKER_ID)
+
+
+LEADER = Leadership()
+
+
+def changes_since(cursor: int, limit: int) -> tuple:
+    """
+    (the oldest change still kept, and for up to `limit` changes after `cursor`: change id, kind, ref,
+    then for tasks their current status, pay, x, y, color, reserver and reservation expiry)
+    """
+    oldest = db.select('SELECT MIN("id") FROM "Change"')[0]
+    changes = db.select("""SELECT c."id", c."kind", c."ref", t."status", t."pay", t."x", t."y", t."color", t."reservation", t."reservation_expires"
+        FROM "Change" c LEFT JOIN "Task" t ON c."kind" = 'task' AND t."id" = c."ref"
+        WHERE c."id" > $cursor ORDER BY c."id" LIMIT $limit""")
+    return oldest, changes
+
+
+class WorkerSync:
+    """
+    Keeps this worker in step with what the others do.
+
+    Every POLL_INTERVAL it replays the Change rows the others' writes appended onto TASK_BOOK, EXPIRY and
+    AUTH_CACHE, from each task's current row, so replaying our own writes or the same change twice is harmless.
+    It also picks up the canvas size from SHARED_STATE and new frames from CANVAS_HISTORY.
+    """
+    POLL_INTERVAL = 0.2  # seconds
+    BATCH_SIZE = 5000
+    RETENTION = timedelta(minutes=10)  # the leader prunes older changes; a worker further behind rebuilds its book
+    RETRY_DELAY = 1  # seconds to wait after a failed poll
+
+    def __init__(self):
+        self.cursor = 0  # the last change applied
+        self.state_generation = None
+
+    def start(self):
+        create_erroring_task(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.POLL_INTERVAL)
+            try:
+                self.sync_canvas()
+                await self.catch_up()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # e.g. the database stayed locked past busy_timeout; the cursor only moves once applied
+                print("Could not sync with the other workers:", repr(e))
+                await asyncio.sleep(self.RETRY_DELAY)
+
+    async def catch_up(self):
+        while True:
+            oldest, changes = await DB.read(changes_since, self.cursor, self.BATCH_SIZE)
+            if oldest is not None and oldest > self.cursor + 1:
+                await self.rebuild()
+                return
+            if changes:
+                self.apply(changes)
+                self.cursor = changes[-1][0]
+            if len(changes) < self.BATCH_SIZE:
+                return
+
+    def apply(self, changes: list):
+        tasks = OrderedDict()  # task id -> its current row, once however many times it changed
+        for _, kind, ref, *task in changes:
+            if kind == 'user':
+                AUTH_CACHE.forget_balance(ref)
+            else:
+                tasks[ref] = task
+
+        added = []
+        for task_id, (status, pay, x, y, color, reserver, expires) in tasks.items():
+            if status == OPEN:
+                EXPIRY.cancel(task_id)
+                task = BookTask(task_id, pay, x, y, color)
+                if task_id in TASK_BOOK.reserved:
+                    TASK_BOOK.add(task)
+                elif task_id not in TASK_BOOK.tasks:
+                    added.append(task)
+            elif status == RESERVED:
+                TASK_BOOK.reserve(BookTask(task_id, pay, x, y, color), reserver)
+                when = datetime.fromisoformat(expires)
+                if EXPIRY.deadlines.get(task_id) != when:
+                    EXPIRY.schedule(task_id, when)
+            else:  # settled, or archived already
+                TASK_BOOK.remove(task_id)
+                EXPIRY.cancel(task_id)
+        if added:
+            TASK_BOOK.add_many(added)
+
+    async def rebuild(self):
+        """We fell behind the pruned change log, so start over from the tables"""
+        def reload():
+            return latest_change(), load_book()
+
+        self.cursor, (open_tasks, reserved_tasks) = await DB.read(reload)
+        EXPIRY.deadlines.clear()
+        restock_book(open_tasks, reserved_tasks)
+        for subscription in list(TASK_FEED.subscribers):  # they'd have missed changes too; reconnecting resyncs them
+            TASK_FEED.drop(subscription)
+        await log("Fell behind the change log, rebuilt the task book", worker=WORKER_ID)
+
+    def sync_canvas(self):
+        global CANVAS_WIDTH, CANVAS_HEIGHT, CURRENT_CANVAS, CANVAS_UPDATED_AT
+        generation = SHARED_STATE.generation
+        if generation != self.state_generation:
+            self.state_generation = generation
+            width, height = SHARED_STATE.canvas_size()
+            if width and (width, height) != (CANVAS_WIDTH, CANVAS_HEIGHT):
+                CANVAS_WIDTH, CANVAS_HEIGHT = width, height
+                TASK_BOOK.resize(width, height)
+        if CANVAS_HISTORY.refresh():
+            pixels, taken_at = CANVAS_HISTORY.latest()
+            CURRENT_CANVAS = pixels
+            CANVAS_UPDATED_AT = datetime.fromtimestamp(taken_at)
+            flag_satisfied(pixels)
+
+
+WORKER_SYNC = WorkerSync()
 
 
 async def canvas_size_loop():
@@ -490,22 +3042,163 @@ async def canvas_size_loop():
         else:
             await asyncio.sleep(TICK_RATE)
         await asyncio.sleep(1)
-        async with aiohttp.ClientSession() as session:
-            async with session.get(API_BASE + "/get_size", headers=HEADERS) as response:
+        if not LEADER.is_leader:
+            continue
+        try:
+            async with UPSTREAM.get("/get_size") as response:
                 if response.status != 200:
-                    await session.post(INFO_WEBHOOK, json=make_embed("Error hit while getting canvas size:", status_code=response.status, error=await result.read()))
+                    await log("Error hit while getting canvas size:", status_code=response.status, error=await response.read())
                     continue
                 try:
                     result = await response.json()
                 except Exception as e:
-                    await session.post(INFO_WEBHOOK, json=make_embed("Error while parsing /get_size json", error=str(e)))
+                    await log("Error while parsing /get_size json", error=str(e))
                     continue
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            await log("Failed to get canvas size:", error=str(e) or "Timed out")
+            continue
+
+        if (CANVAS_WIDTH, CANVAS_HEIGHT) != (result["width"], result["height"]):
+            CANVAS_WIDTH = result["width"]
+            CANVAS_HEIGHT = result["height"]
+            TASK_BOOK.resize(CANVAS_WIDTH, CANVAS_HEIGHT)
+            SHARED_STATE.set_canvas_size(CANVAS_WIDTH, CANVAS_HEIGHT)
+
+            await log("Setting canvas size:", width=CANVAS_WIDTH, height=CANVAS_HEIGHT)
+
+
+async def start_upstream():
+    await UPSTREAM.start()
+
+
+async def close_upstream():
+    await UPSTREAM.close()
+
+
+async def start_shared_state():
+    global CANVAS_WIDTH, CANVAS_HEIGHT
+    SHARED_STATE.open(WORKER_STATE_FILE)
+    with SHARED_STATE.locked():
+        width, height = SHARED_STATE.canvas_size()
+        if width:  # another worker is already up and may know better
+            CANVAS_WIDTH, CANVAS_HEIGHT = width, height
+        else:
+            SHARED_STATE.bump(CANVAS_WIDTH, CANVAS_HEIGHT)
+
+
+async def close_shared_state():
+    SHARED_STATE.close()
+
+
+async def start_leadership():
+    LEADER.start()
 
-                if (CANVAS_WIDTH, CANVAS_HEIGHT) != (result["width"], result["height"]):
-                    CANVAS_WIDTH = result["width"]
-                    CANVAS_HEIGHT = result["height"]
 
-                    await log("Setting canvas size:", width=CANVAS_WIDTH, height=CANVAS_HEIGHT)
+async def resign_leadership():
+    await LEADER.resign()
+
+
+async def start_sync():
+    WORKER_SYNC.start()
+
+
+async def start_expiry():
+    EXPIRY.start()
+
+
+async def start_verifier():
+    PIXEL_VERIFIER.start()
+
+
+async def canvas_loop():
+    while True:
+        await asyncio.sleep(CANVAS_REFRESH_RATE)
+        # nothing to check the canvas against, so save the ratelimit. The other workers pick it up from CANVAS_HISTORY.
+        if LEADER.is_leader and (TASK_BOOK.tasks or TASK_BOOK.reserved):
+            try:
+                await update_canvas()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:  # one bad refresh mustn't stop the rest
+                await log("Canvas refresh failed:", error=repr(e))
+
+
+async def start_canvas_loop():
+    create_erroring_task(canvas_loop())
+
+
+async def load_canvas_history():
+    global CURRENT_CANVAS, CANVAS_UPDATED_AT
+    CANVAS_HISTORY.open(CANVAS_HISTORY_FILE, CANVAS_WIDTH, CANVAS_HEIGHT, CANVAS_HISTORY_FRAMES)
+    pixels, taken_at = CANVAS_HISTORY.latest()
+    if pixels is not None:
+        CURRENT_CANVAS = pixels
+        CANVAS_UPDATED_AT = datetime.fromtimestamp(taken_at)
+
+
+async def close_canvas_history():
+    CANVAS_HISTORY.close()
+
+
+def archive_settled_tasks(cutoff: datetime) -> int:
+    """Move a batch of tasks settled before the cutoff into ArchivedTask, returning how many moved"""
+    tasks = orm.select(
+        task for task in Task
+        if task.status in (COMPLETED, DELETED) and (task.settled_at is None or task.settled_at < cutoff)
+    )[:ARCHIVE_BATCH_SIZE]
+    now = datetime.utcnow()
+    for task in tasks:
+        ArchivedTask(
+            id=task.id,
+            creator=task.creator.id,
+            completed=task.completed and task.completed.id,
+            reservation=task.reservation and task.reservation.id,
+            x=task.x,
+            y=task.y,
+            color=task.color,
+            pay=task.pay,
+            status=task.status,
+            settled_at=task.settled_at,
+            archived_at=now,
+        )
+        task.delete()
+    return len(tasks)
+
+
+def prune_changes(retention: timedelta):
+    age = f"-{int(retention.total_seconds())} seconds"
+    db.execute('DELETE FROM "Change" WHERE "at" < datetime(\'now\', $age)')
+
+
+async def compact():
+    """Keep the live Task table down to open and reserved work, a batch per transaction so writes keep flowing"""
+    await DB.write(prune_changes, WorkerSync.RETENTION)
+    cutoff = datetime.utcnow() - ARCHIVE_AFTER
+    archived = 0
+    while True:
+        moved = await DB.write(archive_settled_tasks, cutoff)
+        archived += moved
+        if moved < ARCHIVE_BATCH_SIZE:
+            break
+    if archived:
+        await log("Archived settled tasks", count=archived)
+
+
+async def compaction_loop():
+    while True:
+        await asyncio.sleep(ARCHIVE_INTERVAL)
+        if not LEADER.is_leader:
+            continue
+        try:
+            await compact()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:  # try again next interval
+            print("Compaction failed:", repr(e))
+
+
+async def start_compaction():
+    create_erroring_task(compaction_loop())
 
 
 async def start_size_loop():
@@ -518,10 +3211,11 @@ def create_erroring_task(coroutine):
 
     def ensure_exception(fut: asyncio.Future) -> None:
         """Ensure an exception in a task is raised without hard awaiting."""
-        if fut.done() and not fut.cancelled():
+        if fut.cancelled():
             return
         fut.result()
     task.add_done_callback(ensure_exception)
+    return task
 
 
 def make_embed(content: str, **kwargs):
@@ -537,28 +3231,235 @@ def make_embed(content: str, **kwargs):
     return {"embeds": [embed]}
 
 
+class LogDispatcher:
+    """
+    Posts log embeds to INFO_WEBHOOK from the background, so logging never waits on discord.
+
+    Embeds queue up to QUEUE_SIZE and go out up to MAX_EMBEDS to a message, pausing whenever the webhook's
+    ratelimit headers say to. An embed that would push a message past MAX_CHARACTERS waits to start the next one.
+    If discord can't keep up and the queue fills, new embeds are dropped and a count of them is sent later.
+    """
+    QUEUE_SIZE = 1000
+    MAX_EMBEDS = 10  # per message, discord's limit
+    MAX_CHARACTERS = 6000  # across all embeds in a message, discord's limit
+    MAX_FIELD_LENGTH = 1024
+    BATCH_WINDOW = 1  # seconds to wait for more embeds to share a message with
+    MAX_ATTEMPTS = 3
+
+    def __init__(self):
+        self.queue = None
+        self.session = None
+        self.worker = None
+        self.dropped = 0  # since we last said so
+        self.held = None  # an embed already off the queue that didn't fit in the last message
+
+    def start(self, webhook: str):
+        self.queue = asyncio.Queue(self.QUEUE_SIZE)
+        if webhook:
+            self.worker = create_erroring_task(self.run(webhook))
+
+    async def close(self, timeout: float = 5):
+        """Give what's queued a few seconds to go out, then stop"""
+        if self.worker is None:
+            return
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(self.queue.join(), timeout)
+        self.worker.cancel()
+        if self.session:
+            await self.session.close()
+        self.worker = self.session = None
+
+    def __len__(self):
+        return (0 if self.queue is None else self.queue.qsize()) + (self.held is not None)
+
+    def submit(self, embed: dict):
+        if self.worker is None:
+            return
+        try:
+            self.queue.put_nowait(embed)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            METRICS.log_embeds["dropped"] += 1
+
+    @classmethod
+    def size(cls, embed: dict) -> int:
+        return len(embed.get("description", "")) + sum(len(field["name"]) + len(field["value"]) for field in embed.get("fields", ()))
+
+    @classmethod
+    def trimmed(cls, embed: dict) -> dict:
+        for field in embed.get("fields", ()):
+            if len(field["value"]) > cls.MAX_FIELD_LENGTH:
+                field["value"] = field["value"][:cls.MAX_FIELD_LENGTH - 3] + "..."
+        return embed
+
+    async def next_batch(self) -> tuple:
+        """
+        Wait for an embed, then take whatever else turns up within BATCH_WINDOW that fits in the same message.
+        Returns (embeds, how many of them came off the queue).
+        """
+        if self.held is not None:
+            batch, self.held = [self.held], None
+        else:
+            batch = [self.trimmed(await self.queue.get())]
+        characters = self.size(batch[0])
+        deadline = time.monotonic() + self.BATCH_WINDOW
+        while len(batch) < self.MAX_EMBEDS - bool(self.dropped):  # leaving room to own up to drops
+            if self.queue.empty():
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    embed = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                embed = self.queue.get_nowait()
+            embed = self.trimmed(embed)
+            characters += self.size(embed)
+            if characters > self.MAX_CHARACTERS - 100:
+                self.held = embed  # still counts as unfinished on the queue until the message it starts goes out
+                break
+            batch.append(embed)
+        taken = len(batch)
+        if self.dropped:
+            batch.append(make_embed(f"{self.dropped} log messages were dropped while discord caught up")["embeds"][0])
+            self.dropped = 0
+        return batch, taken
+
+    async def run(self, webhook: str):
+        while True:
+            batch, taken = await self.next_batch()
+            if self.session is None:
+                # only now, so importing aiohttp needn't hold up startup.
+                # Kept apart from UPSTREAM so the pixels API key never goes to discord
+                self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+            try:
+                await self.send(webhook, {"embeds": batch})
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                print("Failed to send logs to discord:", e)
+                METRICS.log_embeds["failed"] += len(batch)
+            finally:
+                for _ in range(taken):
+                    self.queue.task_done()
+
+    async def send(self, webhook: str, payload: dict):
+        for _ in range(self.MAX_ATTEMPTS):
+            async with self.session.post(webhook, json=payload) as response:
+                if response.status == 429:
+                    retry_after = float(response.headers.get("Retry-After") or (await response.json()).get("retry_after", 1))
+                    METRICS.log_embeds["ratelimited"] += 1
+                    await asyncio.sleep(retry_after)
+                    continue
+                if response.status >= 400:
+                    print("Discord rejected our logs:", response.status, await response.text())
+                    METRICS.log_embeds["failed"] += len(payload["embeds"])
+                    return
+                METRICS.log_embeds["sent"] += len(payload["embeds"])
+                if response.headers.get("X-RateLimit-Remaining") == "0":
+                    await asyncio.sleep(float(response.headers.get("X-RateLimit-Reset-After") or 1))
+                return
+        METRICS.log_embeds["failed"] += len(payload["embeds"])
+
+
+LOG_DISPATCHER = LogDispatcher()
+
+
 async def log(content: str, **kwargs):
-    """Logging convenience method"""
+    """Logging convenience method. Never waits on discord: the embed is only queued for LOG_DISPATCHER"""
     print("Logging:", content, kwargs)
-    #async with aiohttp.ClientSession() as session:
-    #    await session.post(INFO_WEBHOOK, json=make_embed(content=content, **kwargs))
+    LOG_DISPATCHER.submit(make_embed(content=content, **kwargs)["embeds"][0])
+
+
+async def start_log_dispatcher():
+    LOG_DISPATCHER.start(INFO_WEBHOOK)
+
+
+async def close_log_dispatcher():
+    await LOG_DISPATCHER.close()
+
 
 async def log_startup():
     await log("Server is coming up!")
 
+
+async def start_warm_up():
+    STARTUP.finish('serving')
+    create_erroring_task(warm_up())
+
 app = Starlette(
     debug=True,
+    exception_handlers={Rejected: rejected_response},
+    middleware=[Middleware(MetricsMiddleware)],
     routes=[
         Route('/', homepage),
         Route('/tasks', fetch_tasks, methods=['GET']),
         Route('/tasks', create_task, methods=['POST']),
+        Route('/tasks/bulk', create_tasks_bulk, methods=['POST']),
+        Route('/tasks/reserve', reserve_tasks, methods=['POST']),
+        Route('/tasks/stream', stream_tasks, methods=['GET']),
+        WebSocketRoute('/tasks/stream', stream_tasks_websocket),
         Route('/tasks/{task_id:int}', reserve_task, methods=['GET']),
         Route('/tasks/{task_id:int}', submit_task, methods=['POST']),
         Route('/tasks/stats', task_stats, methods=['GET']),
+        Route('/tasks/heatmap.png', heatmap_png, methods=['GET']),
+        Route('/canvas.png', canvas_png, methods=['GET']),
         Route('/balance', balance, methods=['GET']),
         Route('/balance/{user_id:int}', fix_economy, methods=['POST']),
+        Route('/metrics', metrics, methods=['GET']),
+        Route('/healthz', healthz, methods=['GET']),
+        Route('/readyz', readyz, methods=['GET']),
         Route('/tasks/{task_id:int}', delete_task, methods=['DELETE']),
     ],
-    on_startup=[start_database, start_size_loop, log_startup],
+    # only what /healthz and the database reads need; warm_up() does the rest in the background
+    on_startup=[start_log_dispatcher, start_shared_state, start_database, log_startup, start_warm_up],
+    on_shutdown=[resign_leadership, close_upstream, close_canvas_history, close_shared_state, close_log_dispatcher],
 )
 #orm.set_sql_debug(True)
+
+
+if __name__ == "__main__":
+    def rebuild_stats_command():
+        with orm.db_session():
+            rebuild_stats()
+        print("Stats rebuilt")
+
+    def verify_stats_command():
+        with orm.db_session():
+            mismatches = verify_stats()
+        for user_id, counter, running, scanned in mismatches:
+            print(f"user {user_id}: {counter} is {running}, scan says {scanned}")
+        print(f"{len(mismatches)} mismatches")
+        return 1 if mismatches else 0
+
+    def explain_command():
+        with orm.db_session():
+            plans = explain_queries()
+        for name, lines in plans.items():
+            print(name)
+            for line in lines:
+                print("   ", line)
+        scans = full_scans(plans)
+        print(f"{len(scans)} queries scan the whole table" + (": " + ", ".join(scans) if scans else ""))
+        return 1 if scans else 0
+
+    def pixel_at_command(x, y, when=None):
+        """For settling disputes: what we saw at (x, y) at a UTC ISO time, or in our latest frame"""
+        CANVAS_HISTORY.open(CANVAS_HISTORY_FILE, CANVAS_WIDTH, CANVAS_HEIGHT, CANVAS_HISTORY_FRAMES)
+        when = datetime.fromisoformat(when.rstrip("Z")).replace(tzinfo=timezone.utc).timestamp() if when else time.time()
+        color, taken_at = CANVAS_HISTORY.pixel_at(int(x), int(y), when)
+        if color is None:
+            print(f"No frame from that far back; {len(CANVAS_HISTORY)} frames kept")
+            return 1
+        print(f"({x}, {y}) was {color} at {datetime.utcfromtimestamp(taken_at).isoformat()}Z")
+
+    commands = {
+        "rebuild-stats": rebuild_stats_command,
+        "verify-stats": verify_stats_command,
+        "explain": explain_command,
+        "pixel-at": pixel_at_command,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        sys.exit("Usage: python main.py " + "|".join(commands) + " [args]")
+
+    bind_database()
+    sys.exit(commands[sys.argv[1]](*sys.argv[2:]))